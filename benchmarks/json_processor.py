@@ -0,0 +1,165 @@
+"""Measures events/sec of MonitorOutputProcessorJSON, including rendering
+of the events with EventFormatter.
+
+Usage, from the repository root:
+
+    python -m benchmarks.json_processor [capture] [chunk size]
+
+`capture` is recorded `cilium monitor --json` output. If it is not given, a
+synthetic capture is built from trace, drop and l7 events. The capture is
+fed to the processor in chunks of `chunk size` bytes (4096 by default), as
+it would arrive from the exec websocket. A chunk size larger than the
+capture simulates draining a backlog.
+"""
+import json
+import sys
+import time
+
+from microscope.monitor import jsoncodec
+from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.formatter import EventFormatter
+from microscope.monitor.parser import MonitorOutputProcessorJSON
+
+
+trace = {
+    "cpu": "CPU 01:", "type": "trace", "mark": "0xd3f88100",
+    "ifindex": "lxca3b25", "state": "reply",
+    "observationPoint": "to-endpoint", "traceSummary": "-> endpoint 5766",
+    "source": 5766, "bytes": 66, "srcLabel": 49055, "dstLabel": 20496,
+    "dstID": 5766,
+    "summary": {
+        "l2": {"src": "22:46:9b:ed:13:e9", "dst": "06:ea:01:96:66:ef"},
+        "l3": {"src": "10.0.0.1", "dst": "10.0.0.2"},
+        "l4": {"src": "80", "dst": "37934"}
+    }
+}
+
+drop = dict(trace, type="drop", reason="Policy denied (L3)")
+
+l7 = {
+    "type": "logRecord", "observationPoint": "Ingress",
+    "flowType": "Request", "l7Proto": "http", "srcEpID": 0,
+    "srcEpLabels": ["k8s:io.kubernetes.pod.namespace=default",
+                    "k8s:id=app2"],
+    "srcIdentity": 3338, "dstEpID": 13949,
+    "dstEpLabels": ["k8s:id=app1", "k8s:io.kubernetes.pod.namespace=default"],
+    "DstIdentity": 45459, "verdict": "Denied",
+    "http": {"Code": 403, "Method": "GET",
+             "URL": {"Scheme": "http", "Host": "app1-service",
+                     "Path": "/private/{id}"},
+             "Protocol": "HTTP/1.1",
+             "Headers": {"Accept": ["*/*"],
+                         "User-Agent": ["curl/7.54.0"]}}
+}
+
+endpoints = [
+    {
+        'id': 5766,
+        'status': {
+            'external-identifiers': {'pod-name': 'default:app2'},
+            'networking': {'addressing': [{'ipv4': '10.0.0.1'}]},
+            'identity': {'id': 49055, 'labels': ['k8s:id=app2']},
+        }
+    },
+    {
+        'id': 30391,
+        'status': {
+            'external-identifiers': {'pod-name': 'default:app1'},
+            'networking': {'addressing': [{'ipv4': '10.0.0.2'}]},
+            'identity': {'id': 20496, 'labels': ['k8s:id=app1']},
+        }
+    },
+]
+
+
+def synthetic_capture(count: int) -> str:
+    events = [trace, drop, trace, l7]
+    return "".join(json.dumps(events[i % len(events)], indent=4) + "\n"
+                   for i in range(count))
+
+
+class LegacyProcessor(MonitorOutputProcessorJSON):
+    """LegacyProcessor is the string rescanning implementation which
+    MonitorOutputProcessorJSON used before JSONEventFramer
+    """
+    def __init__(self):
+        super().__init__()
+        self.std_output = ""
+
+    def add_out(self, out: str):
+        self.std_output += out
+
+    def get_event(self) -> str:
+        stack = []
+        opening = 0
+        closing = 0
+
+        for i, c in enumerate(self.std_output):
+            if c == "{":
+                stack.append(i)
+            if c == "}":
+                opening = stack.pop()
+                if len(stack) == 0:
+                    closing = i
+                    break
+        if closing > opening:
+            ret = self.std_output[opening:closing+1]
+            self.std_output = self.std_output[closing+1:]
+            return ret
+        else:
+            return None
+
+    def __next__(self) -> str:
+        if not self.std_output:
+            raise StopIteration
+
+        event = self.get_event()
+        if event is None:
+            raise StopIteration
+
+        return self.parse_event(json.loads(event, strict=False))
+
+
+def run(processor, formatter, chunks) -> int:
+    count = 0
+    for chunk in chunks:
+        processor.add_out(chunk)
+        for event in processor:
+            formatter.format(event)
+            count += 1
+    return count
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            capture = f.read()
+    else:
+        capture = synthetic_capture(20000)
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    chunks = [capture[i:i+chunk_size]
+              for i in range(0, len(capture), chunk_size)]
+
+    formatter = EventFormatter(EndpointResolver(endpoints))
+    variants = [("before (rescan + json.loads)", LegacyProcessor, None),
+                ("after, stdlib raw_decode", MonitorOutputProcessorJSON,
+                 "stdlib")]
+    if jsoncodec.orjson is not None:
+        variants.append(("after, orjson", MonitorOutputProcessorJSON,
+                         "orjson"))
+
+    for name, processor_class, backend in variants:
+        if backend:
+            jsoncodec.use_backend(backend)
+        start = time.perf_counter()
+        count = run(processor_class(), formatter, chunks)
+        elapsed = time.perf_counter() - start
+        print(f"{name:32} {count} events "
+              f"{count / elapsed:12.0f} events/sec")
+
+    for cache, (hits, misses) in formatter.cache_stats().items():
+        print(f"formatter {cache} cache: {hits} hits, {misses} misses")
+
+
+if __name__ == '__main__':
+    main()
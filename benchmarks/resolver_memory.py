@@ -0,0 +1,101 @@
+"""Measures memory and lookup speed of EndpointResolver on a large
+synthetic cluster.
+
+Usage, from the repository root:
+
+    python -m benchmarks.resolver_memory [endpoints]
+
+Endpoints (100000 by default) are spread over 50 namespaces and 2000
+deployments, each with an IPv4 and an IPv6 address, like decoded CEP
+listings. Memory is the size of everything the resolver keeps alive,
+measured with tracemalloc after the listing itself is freed.
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from microscope.monitor.epresolver import EndpointResolver, get_pod_name
+
+
+def synthetic_endpoint(i: int) -> dict:
+    ns = f"namespace-{i % 50}"
+    app = f"app-{i % 2000}"
+    return {
+        'id': 1000 + i,
+        'status': {
+            'external-identifiers': {
+                'pod-name': f"{ns}:{app}-7d9f8b6c4-{i:05x}"},
+            'networking': {'addressing': [
+                {'ipv4': f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+                 'ipv6': f"f00d::a0f:0:{i >> 16:x}:{i & 0xffff:x}"}]},
+            'identity': {
+                'id': 10000 + i % 2000,
+                'labels': [f"k8s:app={app}",
+                           f"k8s:io.kubernetes.pod.namespace={ns}"]},
+            'labels': {'security-relevant': [
+                f"k8s:app={app}",
+                f"k8s:io.kubernetes.pod.namespace={ns}"]},
+        }
+    }
+
+
+class LegacyResolver:
+    """LegacyResolver is the representation EndpointResolver used before:
+    the endpoint list is kept and addresses and ids are string keys
+    """
+    def __init__(self, endpoint_data):
+        self.endpoint_data = endpoint_data
+        self.ip_resolutions = {}
+        self.epid_resolutions = {}
+        self.ip_to_epid_resolutions = {}
+        self.identities = {}
+        for ep in endpoint_data:
+            podname = get_pod_name(ep)
+            for ip in ep['status']['networking']['addressing']:
+                for family in ('ipv4', 'ipv6'):
+                    if family in ip:
+                        self.ip_resolutions[ip[family]] = podname
+                        self.ip_to_epid_resolutions[ip[family]] = ep['id']
+            self.epid_resolutions[str(ep['id'])] = podname
+            identity = ep['status']['identity']
+            self.identities[identity['id']] = identity['labels']
+
+    def resolve_ip(self, ip) -> str:
+        if ip in self.ip_resolutions:
+            return self.ip_resolutions[ip]
+        return ""
+
+
+def measure(name, build, count, passes=10):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    resolver = build(synthetic_endpoint(i) for i in range(count))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+           for i in range(0, count, 7)]
+    # events repeat the same addresses, each is resolved `passes` times
+    start = time.perf_counter()
+    for _ in range(passes):
+        for ip in ips:
+            resolver.resolve_ip(ip)
+    lookups = passes * len(ips) / (time.perf_counter() - start)
+
+    print(f"{name:10} {size / 2**20:8.1f} MiB  built in {elapsed:5.2f}s"
+          f"  {lookups:10.0f} resolve_ip/sec")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{count} endpoints")
+    measure("before", lambda eps: LegacyResolver(list(eps)), count)
+    measure("after", EndpointResolver, count)
+
+
+if __name__ == '__main__':
+    main()
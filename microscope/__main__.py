@@ -1,5 +1,7 @@
+from typing import List
 import argparse
 import signal
+import sys
 
 from kubernetes import config
 from kubernetes.client import Configuration
@@ -7,30 +9,22 @@ from kubernetes.client.apis import core_v1_api
 
 from microscope.monitor.runner import MonitorRunner, MonitorArgs
 from microscope.monitor.runner import NoEndpointException
+from microscope.monitor.transport import drop_policies
+from microscope.monitor.cidr import load_cidr_names
 from microscope.ui.ui import ui
 from microscope.batch.batch import batch
+from microscope.replay.replay import replay, parse_time
 
 
-def main():
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument('--timeout-monitors', type=int, default=0,
-                        help='Will remove monitor output which did '
-                        'not update in last `timeout` seconds. '
-                        'Will not work on last monitor on screen.')
-    parser.add_argument('--verbose', action='store_true', default=False)
-    parser.add_argument('--hex', action='store_true', default=False)
-
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    """add_filter_arguments adds the event filters shared by live and
+    replay modes
+    """
     # taken from github.com/cilium/cilium/cmd/monitor.go
     type_choices = ['drop', 'debug', 'capture', 'trace', 'l7', 'agent']
     parser.add_argument('--type', action='append', default=[],
                         choices=type_choices)
 
-    parser.add_argument('--node', action='append', default=[],
-                        help='Specify which nodes monitor will be run on. '
-                        'Can match either by cilium pod names or k8s node '
-                        'names. Can specify multiple.')
-
     parser.add_argument('--selector', action='append', default=[],
                         help='k8s equality label selectors for pods which '
                         'monitor should listen to. each selector will '
@@ -85,6 +79,88 @@ def main():
     parser.add_argument('--from-ip', action='append', default=[],
                         help='K8s pod ips. Can specify multiple.')
 
+    parser.add_argument('--substring-selectors', action='store_true',
+                        default=False,
+                        help='Match selectors as substrings of endpoint '
+                        'labels instead of exact "label-name=label-value" '
+                        'pairs, like older versions did')
+
+    parser.add_argument('-n', '--namespace', type=str, default='default',
+                        help='Namespace to look for selected endpoints in')
+
+
+def get_monitor_args(args: argparse.Namespace) -> MonitorArgs:
+    return MonitorArgs(args.verbose, args.hex,
+                       args.selector, args.pod, args.endpoint,
+                       args.to_selector, args.to_pod,
+                       args.to_endpoint, args.from_selector,
+                       args.from_pod, args.from_endpoint, args.type,
+                       args.namespace, args.raw,
+                       args.ip, args.to_ip, args.from_ip,
+                       args.substring_selectors)
+
+
+def replay_main(argv: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='microscope replay',
+        description='Print monitor output recorded with --record')
+    parser.add_argument('directory', help='Directory passed to --record')
+    parser.add_argument('--node', action='append', default=[],
+                        help='Only print events of these k8s nodes. '
+                        'Can specify multiple.')
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help='Only print events received at or after this '
+                        'time, a unix timestamp or ISO 8601 time')
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help='Only print events received at or before this '
+                        'time, a unix timestamp or ISO 8601 time')
+    add_filter_arguments(parser)
+    parser.add_argument('--output', type=str, default='text',
+                        choices=['text', 'ndjson'],
+                        help='Output format, like in batch mode')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of processes parsing recorded '
+                        'segments. Defaults to the number of CPUs')
+    parser.set_defaults(verbose=False, hex=False, raw=False)
+
+    args = parser.parse_args(argv)
+    try:
+        replay(args.directory, get_monitor_args(args), args.namespace,
+               args.node, args.since, args.until, args.output,
+               args.workers or None)
+    except KeyboardInterrupt:
+        pass
+    except NoEndpointException:
+        print("Cilium endpoints matching pod names/label selectors not found "
+              "in the recorded endpoints.", file=sys.stderr)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        replay_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--timeout-monitors', type=int, default=0,
+                        help='Will remove monitor output which did '
+                        'not update in last `timeout` seconds. '
+                        'Will not work on last monitor on screen.')
+    parser.add_argument('--verbose', action='store_true', default=False)
+    parser.add_argument('--hex', action='store_true', default=False)
+
+    parser.add_argument('--node', action='append', default=[],
+                        help='Specify which nodes monitor will be run on. '
+                        'Can match either by cilium pod names or k8s node '
+                        'names. Can specify multiple.')
+
+    add_filter_arguments(parser)
+
+    parser.add_argument('--cidr-names', type=str, default='',
+                        help='File with "CIDR name" lines. Addresses in '
+                        'these CIDRs which are not endpoints are shown by '
+                        'name, the longest matching CIDR wins')
+
     parser.add_argument('--send-command', type=str, default="",
                         help='Execute command as-provided in argument on '
                         'all specified nodes and show output.')
@@ -98,15 +174,105 @@ def main():
 
     parser.add_argument('--rich', action='store_true', default=False,
                         help='Opens rich ui version')
+    parser.add_argument('--output', type=str, default='text',
+                        choices=['text', 'ndjson'],
+                        help='Output format of batch mode. ndjson prints '
+                        'one JSON object per event, with resolved source '
+                        'and destination')
+    parser.add_argument('--line-buffered', action='store_true',
+                        default=False,
+                        help='Print every event as soon as it arrives '
+                        'instead of buffering output for up to 100ms')
+    parser.add_argument('--scrollback', type=int, default=10000,
+                        help='Lines of output kept per node in rich ui')
+    parser.add_argument('--scrollback-spill', type=str, default='',
+                        help='Directory to append lines dropped from the '
+                        'rich ui scrollback to, one file per node')
+    parser.add_argument('--fps', type=int, default=20,
+                        help='Maximum screen updates per second in rich ui')
+    parser.add_argument('--capture', type=str, default='',
+                        help='Directory to write all rich ui output to '
+                        'while running, one rotated file per node. '
+                        'Without it, s starts capturing to the current '
+                        'directory')
 
-    parser.add_argument('-n', '--namespace', type=str, default='default',
-                        help='Namespace to look for selected endpoints in')
+    parser.add_argument('--record', type=str, default='',
+                        help='Directory to record raw monitor output of '
+                        'every node to, in compressed segments with a time '
+                        'index. Not available with --verbose, --hex and '
+                        '--raw')
 
     parser.add_argument('--raw', action='store_true', default=False,
                         help='Print out raw monitor output without parsing')
 
+    parser.add_argument('--engine', type=str, default='process',
+                        choices=['process', 'asyncio'],
+                        help='"process" runs a process per Cilium node, '
+                        '"asyncio" follows all nodes from a few processes '
+                        'running an asyncio event loop each. '
+                        'Use asyncio for large clusters')
+    parser.add_argument('--engine-workers', type=int, default=1,
+                        help='Number of processes used by asyncio engine. '
+                        'Nodes are split evenly between them')
+
+    parser.add_argument('--transport', type=str, default='queue',
+                        choices=['queue', 'shm'],
+                        help='How monitor output is sent to the terminal. '
+                        '"shm" uses a shared memory ring buffer per node, '
+                        'requires Python 3.8')
+    parser.add_argument('--ring-size', type=int, default=4,
+                        help='Size of shared memory ring buffer per node '
+                        'in MiB')
+
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='Maximum number of output batches waiting to '
+                        'be shown. 0 is unbounded')
+    parser.add_argument('--drop-policy', type=str, default='block',
+                        choices=drop_policies,
+                        help='What to do with node output when the queue is '
+                        'full. "block" stops reading from the node, '
+                        '"drop-newest" and "drop-oldest" drop batches of '
+                        'output, "sample" keeps every 10th event')
+    parser.add_argument('--node-drop-policy', action='append', default=[],
+                        help='Drop policy for a single node in form of '
+                        '"node-name=policy". Can specify multiple.')
+
+    parser.add_argument('--no-endpoint-watch', action='store_true',
+                        default=False,
+                        help='Resolve endpoints listed at startup only, '
+                        'instead of watching endpoints created and deleted '
+                        'while running')
+    parser.add_argument('--all-namespace-endpoints', action='store_true',
+                        default=False,
+                        help='List endpoints of all namespaces even if '
+                        'filters only reference a single namespace, so '
+                        'pods of other namespaces are shown by name')
+
     args = parser.parse_args()
 
+    if args.fps < 1:
+        parser.error('--fps must be at least 1')
+    if args.engine_workers < 1:
+        parser.error('--engine-workers must be at least 1')
+
+    node_drop_policies = {}
+    for p in args.node_drop_policy:
+        node, _, policy = p.partition('=')
+        if policy not in drop_policies:
+            parser.error(f'invalid drop policy "{policy}" for node {node}')
+        node_drop_policies[node] = policy
+
+    if args.record and (args.verbose or args.hex or args.raw
+                        or args.send_command):
+        parser.error('--record only records JSON monitor output')
+
+    cidr_names = []
+    if args.cidr_names:
+        try:
+            cidr_names = load_cidr_names(args.cidr_names)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
     try:
         config.load_kube_config()
     except FileNotFoundError:
@@ -116,15 +282,15 @@ def main():
     c.assert_hostname = False
     Configuration.set_default(c)
     api = core_v1_api.CoreV1Api()
-    runner = MonitorRunner(args.cilium_namespace, api, args.namespace)
+    runner = MonitorRunner(args.cilium_namespace, api, args.namespace,
+                           args.engine, args.engine_workers,
+                           args.transport, args.ring_size * 1024 * 1024,
+                           args.queue_size, args.drop_policy,
+                           node_drop_policies, not args.no_endpoint_watch,
+                           not args.all_namespace_endpoints, cidr_names,
+                           args.record or None)
 
-    monitor_args = MonitorArgs(args.verbose, args.hex,
-                               args.selector, args.pod, args.endpoint,
-                               args.to_selector, args.to_pod,
-                               args.to_endpoint, args.from_selector,
-                               args.from_pod, args.from_endpoint, args.type,
-                               args.namespace, args.raw,
-                               args.ip, args.to_ip, args.from_ip)
+    monitor_args = get_monitor_args(args)
 
     def handle_signals(_, __):
         runner.finish()
@@ -138,15 +304,19 @@ def main():
         runner.run(monitor_args, args.node, cmd)
         signal.signal(signal.SIGHUP, handle_signals)
         if args.rich:
-            ui(runner, args.timeout_monitors)
+            ui(runner, args.timeout_monitors, args.scrollback,
+               args.scrollback_spill, args.fps, args.capture)
         elif not args.clear_monitors:
-            batch(runner, args.timeout_monitors)
+            batch(runner, args.timeout_monitors, args.line_buffered,
+                  args.output)
     except KeyboardInterrupt:
         pass
     except NoEndpointException:
-        print("Cilium endpoints matching pod names/label selectors not found.")
+        print("Cilium endpoints matching pod names/label selectors not found.",
+              file=sys.stderr)
     except Exception as e:
-        print("Exception encountered: " + repr(e) + " stack trace below")
+        print("Exception encountered: " + repr(e) + " stack trace below",
+              file=sys.stderr)
         raise e
     finally:
         runner.finish()
@@ -2,28 +2,77 @@ import time
 import sys
 from multiprocessing import Queue
 import queue as queuemodule
-import typing.io
+from typing import Dict
 
 from microscope.monitor.runner import MonitorRunner
+from microscope.monitor import jsoncodec
+from microscope.monitor.formatter import EventFormatter, JSONEventFormatter
+from microscope.batch.writer import BatchWriter
 
 
-def batch(runner: MonitorRunner, timeout: int):
+def batch(runner: MonitorRunner, timeout: int, line_buffered: bool = False,
+          output: str = "text"):
+    """batch prints monitor output until monitors exit or `timeout`
+    seconds passed. `output` is "text", or "ndjson" for one JSON object
+    per line.
+    """
+    if output == "ndjson":
+        formatter = JSONEventFormatter(runner.resolver)
+    else:
+        formatter = EventFormatter(runner.resolver)
+    writer = BatchWriter(sys.stdout, line_buffered)
+    dropped = {}
     start_time = time.time()
     while(runner.is_alive() and runner.close_queue.empty()
           and (start_time + timeout > time.time() or timeout == 0)):
-        drain_and_print(runner.data_queue, sys.stdout)
+        drain_and_print(runner.data_queue, writer, formatter, dropped)
 
     # drain queue
-    drain_and_print(runner.data_queue, sys.stdout)
+    drain_and_print(runner.data_queue, writer, formatter, dropped)
 
+    for node, count in runner.overflows().items():
+        if count:
+            if isinstance(formatter, JSONEventFormatter):
+                writer.write(jsoncodec.encode(
+                    {'node': node, 'type': 'overflows',
+                     'overflows': count}) + "\n")
+            else:
+                writer.write(f"\n{node}: shared memory ring was full "
+                             f"{count} times")
+    writer.flush()
 
-def drain_and_print(queue: Queue, stream: typing.io):
+
+def drain_and_print(queue: Queue, writer: BatchWriter,
+                    formatter: EventFormatter, dropped: Dict[str, int]):
+    """drain_and_print prints frames from the queue until it has been
+    empty for a second. dropped keeps the number of dropped events
+    reported per node.
+    """
     while True:
         try:
-            output = queue.get(True, 1)
-            if ("output" in output):
-                print(f"\n{output['node_name']}: {output['output']}",
-                      end="", file=stream)
-                stream.flush()
+            frame = queue.get(True, writer.wait_timeout(1))
         except queuemodule.Empty:
+            if writer.pending:
+                # idle, print what we have before waiting any longer
+                writer.flush()
+                continue
             break
+
+        node = frame.get("node_name")
+        ndjson = isinstance(formatter, JSONEventFormatter)
+        if frame.get("dropped", 0) > dropped.get(node, 0):
+            dropped[node] = frame["dropped"]
+            if ndjson:
+                writer.write(jsoncodec.encode(
+                    {'node': node, 'type': 'dropped',
+                     'dropped': dropped[node]}) + "\n")
+            else:
+                writer.write(f"\n{node}: {dropped[node]} events dropped so "
+                             "far, output can't keep up")
+        if ndjson:
+            writer.write("".join(formatter.format(output, node) + "\n"
+                                 for output in frame.get("outputs", [])))
+        else:
+            for output in frame.get("outputs", []):
+                writer.write(f"\n{node}: {formatter.format(output)}")
+        writer.frame_done()
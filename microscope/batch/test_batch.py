@@ -0,0 +1,34 @@
+import io
+import time
+
+from microscope.batch.writer import BatchWriter
+
+
+def test_batch_writer():
+    stream = io.StringIO()
+    writer = BatchWriter(stream, flush_interval=60, buffer_size=8)
+    assert writer.wait_timeout(1) == 1
+    writer.write("abc")
+    writer.frame_done()
+    assert stream.getvalue() == ""
+    assert 0 < writer.wait_timeout(1) <= 60
+    writer.write("defgh")
+    writer.frame_done()
+    assert stream.getvalue() == "abcdefgh"
+    assert writer.wait_timeout(1) == 1
+
+    stream = io.StringIO()
+    writer = BatchWriter(stream, flush_interval=0.01)
+    writer.write("abc")
+    writer.frame_done()
+    assert stream.getvalue() == ""
+    time.sleep(0.02)
+    assert writer.wait_timeout(1) == 0
+    writer.frame_done()
+    assert stream.getvalue() == "abc"
+
+    stream = io.StringIO()
+    writer = BatchWriter(stream, line_buffered=True, flush_interval=60)
+    writer.write("abc")
+    writer.frame_done()
+    assert stream.getvalue() == "abc"
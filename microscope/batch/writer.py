@@ -0,0 +1,48 @@
+import time
+import typing.io
+
+
+class BatchWriter:
+    """BatchWriter collects output in memory and writes it to the stream
+    in large chunks. Output is flushed when `buffer_size` characters are
+    pending, when it has been pending for `flush_interval` seconds and
+    when the queue is idle. With `line_buffered`, output of every frame
+    is flushed right away, for interactive use.
+    """
+    def __init__(self, stream: typing.io, line_buffered: bool = False,
+                 flush_interval: float = 0.1, buffer_size: int = 64 * 1024):
+        self.stream = stream
+        self.line_buffered = line_buffered
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        self.deadline = None
+
+    def write(self, text: str):
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.flush_interval
+        self.pending.append(text)
+        self.pending_size += len(text)
+
+    def wait_timeout(self, idle: float) -> float:
+        """wait_timeout returns how long the caller can wait for more
+        output before the pending output is due
+        """
+        if self.deadline is None:
+            return idle
+        return max(0, self.deadline - time.monotonic())
+
+    def frame_done(self):
+        if (self.line_buffered or self.pending_size >= self.buffer_size
+                or (self.deadline is not None
+                    and time.monotonic() >= self.deadline)):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+        self.deadline = None
+        self.stream.flush()
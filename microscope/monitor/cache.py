@@ -0,0 +1,50 @@
+from collections import OrderedDict
+import time
+
+
+class LRUCache:
+    """LRUCache is a mapping of at most `maxsize` entries, evicting the
+    least recently used entry when full. Entries expire `ttl` seconds
+    after they were put, if `ttl` is set.
+
+    `hits` and `misses` count get calls, for tuning `maxsize`.
+    """
+    def __init__(self, maxsize: int, ttl: float = None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (value, expiry)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expiry = entry
+            if expiry is None or expiry > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, ttl: float = None):
+        """put adds or replaces an entry, `ttl` overrides the cache ttl"""
+        if ttl is None:
+            ttl = self.ttl
+        expiry = None if ttl is None else self.clock() + ttl
+        self.entries[key] = (value, expiry)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,92 @@
+from typing import List, Tuple
+import ipaddress
+
+
+class PrefixTrie:
+    """PrefixTrie maps IPv4 and IPv6 CIDRs to names and finds the longest
+    prefix matching an address, walking at most one node per prefix bit.
+
+    Nodes are [zero child, one child, name] lists.
+    """
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.sizes = {4: 0, 6: 0}
+
+    def __len__(self):
+        return self.sizes[4] + self.sizes[6]
+
+    def insert(self, cidr: str, name: str):
+        net = ipaddress.ip_network(cidr, strict=False)
+        bits = net.max_prefixlen
+        addr = int(net.network_address)
+
+        node = self.roots[net.version]
+        for i in range(net.prefixlen):
+            bit = (addr >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.sizes[net.version] += 1
+        node[2] = name
+
+    def lookup(self, ip: str) -> str:
+        """lookup returns the name of the longest prefix containing ip,
+        None if there is none or ip is not an address
+        """
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if not self.sizes[addr.version]:
+            return None
+
+        bits = addr.max_prefixlen
+        value = int(addr)
+        node = self.roots[addr.version]
+        match = node[2]
+        for i in range(bits - 1, -1, -1):
+            node = node[(value >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+    def items(self) -> List[Tuple[str, str]]:
+        """items returns (CIDR, name) pairs of all inserted prefixes"""
+        items = []
+        for version, address in ((4, ipaddress.IPv4Address),
+                                 (6, ipaddress.IPv6Address)):
+            bits = 32 if version == 4 else 128
+            stack = [(self.roots[version], 0, 0)]
+            while stack:
+                node, prefix, length = stack.pop()
+                if node[2] is not None:
+                    network = address(prefix << (bits - length))
+                    items.append((f"{network}/{length}", node[2]))
+                for bit in (0, 1):
+                    if node[bit] is not None:
+                        stack.append((node[bit], prefix << 1 | bit,
+                                      length + 1))
+        return items
+
+
+def load_cidr_names(path: str) -> List[Tuple[str, str]]:
+    """load_cidr_names reads "CIDR name" pairs, one per line. Empty lines
+    and lines starting with # are skipped.
+    """
+    names = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                cidr, name = line.split(None, 1)
+                ipaddress.ip_network(cidr, strict=False)
+            except ValueError:
+                raise ValueError(
+                    f'{path}:{lineno}: expected "CIDR name", got "{line}"')
+            names.append((cidr, name.strip()))
+    return names
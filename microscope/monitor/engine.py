@@ -0,0 +1,210 @@
+from typing import List
+import asyncio
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+from multiprocessing.connection import Connection
+
+from kubernetes.client import ApiClient
+from kubernetes.client.apis import core_v1_api
+from websocket import WebSocketException
+
+from microscope.monitor.monitor import Monitor, Backoff, sigint_in_monitor
+from microscope.monitor.transport import BatchSender
+
+
+def split_monitors(monitors: List[Monitor],
+                   workers: int) -> List[List[Monitor]]:
+    """split_monitors splits monitors evenly between `workers` engines,
+    engines which would get no monitors are left out
+    """
+    shards = [monitors[i::workers] for i in range(workers)]
+    return [shard for shard in shards if shard]
+
+
+class AsyncMonitorEngine:
+    """AsyncMonitorEngine follows the exec streams of many monitors in a
+    single process, multiplexing their websockets in one asyncio event loop
+    instead of running a process per Cilium pod.
+
+    Messages are sent to the data queue in the same batch frames as
+    Monitor.connect sends them, so consumers can't tell the difference.
+    Putting frames never blocks the event loop. With the block drop
+    policy, a monitor whose frames don't fit in the queue stops reading
+    its stream until they were sent, other monitors keep running.
+
+    monitors: monitors handled by this engine, they are not started
+    close_queue: queue which is used to signal consumers to finish
+    shutdown: pipe which becomes readable when the engine should finish
+    open_concurrency: number of exec streams being opened at the same time
+    """
+    def __init__(self,
+                 monitors: List[Monitor],
+                 close_queue: Queue,
+                 shutdown: Connection,
+                 open_concurrency: int = 8):
+        self.monitors = monitors
+        self.close_queue = close_queue
+        self.shutdown = shutdown
+        self.open_concurrency = open_concurrency
+        self.closing = None
+        self.local = threading.local()
+
+        self.process = Process(target=self.run)
+
+    def run(self):
+        signal.signal(signal.SIGINT, sigint_in_monitor)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+
+        for m in self.monitors:
+            m.queue.close()
+            m.queue.join_thread()
+        self.close_queue.cancel_join_thread()
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        self.closing = asyncio.Event()
+
+        # Opening exec streams blocks, so it is done by a small pool of
+        # threads. Each thread has its own api client, as `stream` swaps
+        # the request method of the client it is called with.
+        executor = ThreadPoolExecutor(max_workers=self.open_concurrency)
+        followers = [loop.create_task(self.follow(m, executor))
+                     for m in self.monitors]
+
+        def on_shutdown():
+            print("Closing monitors", file=sys.stderr)
+            loop.remove_reader(self.shutdown.fileno())
+            self.closing.set()
+        loop.add_reader(self.shutdown.fileno(), on_shutdown)
+
+        await asyncio.gather(*followers, return_exceptions=True)
+        if not self.closing.is_set():
+            loop.remove_reader(self.shutdown.fileno())
+        executor.shutdown(wait=False)
+
+    def thread_api(self) -> core_v1_api.CoreV1Api:
+        if not hasattr(self.local, "api"):
+            self.local.api = core_v1_api.CoreV1Api(ApiClient())
+        return self.local.api
+
+    async def follow(self, monitor: Monitor, executor: ThreadPoolExecutor):
+        """follow forwards output of the monitor's exec stream and
+        reconnects it like Monitor.connect does
+        """
+        loop = asyncio.get_event_loop()
+        sender = monitor.create_sender(blocking=False)
+        monitor.open_recorder()
+        backoff = Backoff()
+        lost_at = None
+
+        while not self.closing.is_set():
+            try:
+                resp = await loop.run_in_executor(
+                    executor, lambda: monitor.open_stream(self.thread_api()))
+            except Exception as e:
+                if lost_at is None:
+                    print(f'Could not start monitor on {monitor.pod_name}: '
+                          f'{e}', file=sys.stderr)
+                    break
+                resp = None
+
+            if resp is not None:
+                if lost_at is not None:
+                    sender.add(monitor.gap_event(lost_at))
+                connected_at = time.time()
+                await self.follow_stream(monitor, resp, sender)
+                if self.closing.is_set() or not monitor.reconnect:
+                    break
+                lost_at = time.time()
+                backoff.connection_lasted(lost_at - connected_at)
+
+            try:
+                await asyncio.wait_for(self.closing.wait(),
+                                       backoff.next_delay())
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await loop.run_in_executor(
+                    executor, lambda: monitor.resolve_pod(self.thread_api()))
+            except Exception:
+                # retried on the next reconnect attempt
+                pass
+
+        sender.close()
+        monitor.close_recorder()
+
+    async def follow_stream(self, monitor: Monitor, resp,
+                            sender: BatchSender):
+        loop = asyncio.get_event_loop()
+        processor = monitor.create_processor()
+
+        readable = asyncio.Event()
+        fd = resp.sock.sock.fileno()
+        loop.add_reader(fd, readable.set)
+        closing = loop.create_task(self.closing.wait())
+
+        try:
+            while resp.is_open() and not self.closing.is_set():
+                if sender.blocked:
+                    # unread output stays in the socket, the reader is
+                    # removed so the loop doesn't spin on it
+                    loop.remove_reader(fd)
+                    while sender.blocked and not self.closing.is_set():
+                        await asyncio.wait([closing],
+                                           timeout=sender.retry_interval)
+                        sender.flush()
+                    loop.add_reader(fd, readable.set)
+                    continue
+
+                wait_readable = loop.create_task(readable.wait())
+                await asyncio.wait([wait_readable, closing],
+                                   timeout=sender.wait_timeout(
+                                       processor.wait_timeout()),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                has_data = wait_readable.done()
+                wait_readable.cancel()
+                readable.clear()
+
+                # reads one frame, the reader callback fires again
+                # while there is more data on the socket
+                if has_data:
+                    resp.update(timeout=0)
+                elif not closing.done():
+                    processor.on_idle()
+                if resp.peek_stdout():
+                    processor.add_out(resp.read_stdout())
+                if resp.peek_stderr():
+                    processor.add_err(resp.read_stderr())
+
+                for msg in processor:
+                    if msg:
+                        sender.add(msg)
+                sender.flush()
+
+            if resp.is_open():
+                resp.write_stdin('\x03')
+        except (WebSocketException, OSError):
+            # connection lost, follow decides whether to reconnect
+            pass
+        finally:
+            loop.remove_reader(fd)
+            closing.cancel()
+
+        processor.on_idle()
+        for msg in processor:
+            if msg:
+                sender.add(msg)
+        sender.flush()
+
+        resp.close()
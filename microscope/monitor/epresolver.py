@@ -1,4 +1,8 @@
-from typing import Dict, List, Set, Callable
+from typing import Dict, List, Set
+import socket
+import sys
+
+from microscope.monitor.cidr import PrefixTrie
 
 
 # https://github.com/cilium/cilium/blob/master/pkg/identity/numericidentity.go#L33
@@ -11,6 +15,29 @@ reserved_identities = {
     5: ["reserved:init"]
 }
 
+
+def compact_endpoint(ep: Dict) -> Dict:
+    """compact_endpoint returns a copy of the endpoint with only the fields
+    EndpointResolver uses, so the rest of a listing can be freed
+    """
+    status = ep['status']
+    compact = {
+        'external-identifiers': {
+            'pod-name': status['external-identifiers']['pod-name']},
+        'networking': {
+            'addressing': status['networking']['addressing']},
+        'identity': {
+            'id': status['identity']['id'],
+            'labels': status['identity']['labels']},
+    }
+    try:
+        compact['labels'] = {
+            'security-relevant': status['labels']['security-relevant']}
+    except (KeyError, TypeError):
+        pass
+    return {'id': ep['id'], 'status': compact}
+
+
 def get_pod_name(ep):
     try:
         podname = ep['status']['external-identifiers']['pod-name']
@@ -19,128 +46,347 @@ def get_pod_name(ep):
 
     return podname
 
+
+def get_labels(ep) -> List[str]:
+    for getter in label_getters:
+        try:
+            return getter(ep)
+        except (KeyError, TypeError):
+            continue
+    return []
+
+
+label_getters = [
+    lambda x: x['status']['labels']['security-relevant'],
+    lambda x: x['labels']['orchestration-identity'],
+    lambda x: x['labels']['security-relevant']
+]
+
+namespace_label = "io.kubernetes.pod.namespace="
+
+
+def strip_source(label: str) -> str:
+    """strip_source removes the source prefix of a Cilium label,
+    "k8s:id=app1" becomes "id=app1"
+    """
+    key, sep, value = label.partition('=')
+    return key.split(':', 1)[-1] + sep + value
+
+
+# IPv4 addresses are keyed as IPv4-mapped IPv6 addresses, ::ffff:a.b.c.d
+ipv4_mapped = 0xffff << 32
+
+
+def ip_key(ip: str) -> int:
+    """ip_key packs an IPv4 or IPv6 address into an int, None if ip is not
+    an address
+    """
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip),
+                              'big') | ipv4_mapped
+    except (OSError, TypeError):
+        pass
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+    except (OSError, TypeError):
+        return None
+
+
+def ip_str(key: int) -> str:
+    """ip_str returns the address packed by ip_key"""
+    if key >> 32 == 0xffff:
+        return socket.inet_ntop(socket.AF_INET,
+                                (key & 0xffffffff).to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, key.to_bytes(16, 'big'))
+
+
+def snapshot_endpoint(ep_id: int, podname: str, labels: List[str],
+                      ips: List[str]) -> Dict:
+    """snapshot_endpoint returns an endpoint object with the fields of an
+    endpoint saved by EndpointResolver.snapshot
+    """
+    return {'id': ep_id, 'status': {
+        'external-identifiers': {'pod-name': podname},
+        'networking': {'addressing': [
+            {'ipv6' if ':' in ip else 'ipv4': ip} for ip in ips]},
+        # identities are saved separately
+        'identity': {'id': 0, 'labels': []},
+        'labels': {'security-relevant': labels}}}
+
+
+def index_add(index: Dict, key, value):
+    index.setdefault(key, set()).add(value)
+
+
+def index_remove(index: Dict, key, value):
+    values = index.get(key)
+    if values is None:
+        return
+    values.discard(value)
+    if not values:
+        del index[key]
+
+
 class EndpointResolver:
     """EndpointResolver resolves various fields to the pod-name
 
     endpoint_data: a list of lists of endpoint objects obtained from
                    cilium-agent or k8s CEPs
+
+    Endpoint objects are not kept, the resolver is meant to hold the
+    endpoints of large clusters. Addresses are keyed by packed ints,
+    endpoints by their numeric id, and pod names and labels are interned
+    so endpoints of the same deployment share them.
+
+    Endpoints are indexed by pod name and label when added, so selectors
+    are resolved with set lookups instead of scanning all endpoints.
+
+    Addresses which are not endpoint IPs are resolved to names of the
+    longest matching CIDR added with `add_cidr`, e.g. nodes and services.
     """
+    ip_key_cache_size = 65536
+
     def __init__(self,
                  endpoint_data: [Dict]):
 
+        # ip_key(ip) -> endpoint id
         self.ip_resolutions = {}
+        # address string -> ip_key(ip), for addresses of recent events
+        self.ip_keys = {}
+        # endpoint id -> pod name
         self.epid_resolutions = {}
-        self.ip_to_epid_resolutions = {}
-        self.endpoint_data = endpoint_data
+        # endpoint id -> (pod name, labels, *ip keys), all that
+        # remove_endpoint needs
+        self.endpoints = {}
+        self.identities = dict(reserved_identities)
+        # tuple of labels -> shared list of interned labels
+        self.labelsets = {}
+        # pod name -> endpoint id
+        self.pod_index = {}
+        # full label -> endpoint ids
+        self.label_index = {}
+        # label without source -> full labels
+        self.label_keys = {}
+        self.cidr_names = PrefixTrie()
+        # IdentityCache for identities without listed endpoints
+        self.identity_source = None
+        self.generation = 0
 
         for ep in endpoint_data:
-            podname = get_pod_name(ep)
-            for ip in ep['status']['networking']['addressing']:
-                try:
-                    ipv4 = ip['ipv4']
-                    self.ip_resolutions[ipv4] = podname
-                    self.ip_to_epid_resolutions[ipv4] = ep['id']
-                except KeyError:
-                    pass
-                try:
-                    ipv6 = ip['ipv6']
-                    self.ip_resolutions[ipv6] = podname
-                    self.ip_to_epid_resolutions[ipv6] = ep['id']
-                except KeyError:
-                    pass
-
-            # the str(ep['id']) below is needed because the ID is an
-            # int in json
-            self.epid_resolutions[str(ep['id'])] = podname
-
-        ep_identities = {id["id"]: id["labels"] for id in
-                           [e["status"]["identity"]
-                            for e in endpoint_data]}
-
-        self.identities = {**ep_identities, **reserved_identities}
+            self.add_endpoint(ep)
+
+    def intern_labels(self, labels: List[str]) -> List[str]:
+        key = tuple(labels)
+        shared = self.labelsets.get(key)
+        if shared is None:
+            shared = [sys.intern(label) for label in labels]
+            self.labelsets[key] = shared
+        return shared
+
+    def add_endpoint(self, ep: Dict):
+        """add_endpoint indexes a new endpoint or replaces the endpoint
+        with the same id
+        """
+        ep_id = ep['id']
+        if ep_id in self.endpoints:
+            self.remove_endpoint(ep_id)
+
+        podname = sys.intern(get_pod_name(ep))
+        keys = []
+        for ip in ep['status']['networking']['addressing']:
+            for family in ('ipv4', 'ipv6'):
+                key = ip_key(ip.get(family))
+                if key is not None:
+                    self.ip_resolutions[key] = ep_id
+                    keys.append(key)
+
+        self.epid_resolutions[ep_id] = podname
+
+        identity = ep['status']['identity']
+        if identity['id'] not in reserved_identities:
+            self.identities[identity['id']] = self.intern_labels(
+                identity['labels'])
+
+        labels = self.intern_labels(get_labels(ep))
+        self.pod_index[podname] = ep_id
+        for label in labels:
+            index_add(self.label_index, label, ep_id)
+            index_add(self.label_keys, strip_source(label), label)
+
+        self.endpoints[ep_id] = (podname, labels, *keys)
+        self.changed()
+
+    def remove_endpoint(self, ep_id: int):
+        """remove_endpoint drops an endpoint from the indexes. Identities
+        are kept, they can be shared by other endpoints and their labels
+        never change.
+        """
+        record = self.endpoints.pop(ep_id, None)
+        if record is None:
+            return
+        podname, labels, *keys = record
+
+        for key in keys:
+            if self.ip_resolutions.get(key) == ep_id:
+                del self.ip_resolutions[key]
+
+        self.epid_resolutions.pop(ep_id, None)
+
+        if self.pod_index.get(podname) == ep_id:
+            del self.pod_index[podname]
+        for label in labels:
+            index_remove(self.label_index, label, ep_id)
+            if label not in self.label_index:
+                index_remove(self.label_keys, strip_source(label), label)
+        self.changed()
+
+    def replace_endpoints(self, endpoint_data: [Dict]):
+        """replace_endpoints swaps all endpoints for a fresh listing"""
+        for ep in endpoint_data:
+            self.add_endpoint(ep)
+        self.retain_endpoints({ep['id'] for ep in endpoint_data})
+
+    def retain_endpoints(self, ep_ids: Set[int]):
+        """retain_endpoints removes all endpoints not in ep_ids"""
+        for ep_id in list(self.endpoints):
+            if ep_id not in ep_ids:
+                self.remove_endpoint(ep_id)
+
+    def add_cidr(self, cidr: str, name: str):
+        """add_cidr names addresses in cidr which are not endpoint IPs"""
+        self.cidr_names.insert(cidr, name)
+        self.changed()
+
+    def snapshot(self) -> Dict:
+        """snapshot returns endpoints, identities and CIDR names known to
+        the resolver as JSON serializable data, for load_snapshot. It can
+        be taken while the endpoint watch thread changes the resolver.
+        """
+        # list() copies the dicts without the watch thread interleaving
+        return {
+            'endpoints': [
+                [ep_id, podname, labels, [ip_str(key) for key in keys]]
+                for ep_id, (podname, labels, *keys)
+                in list(self.endpoints.items())],
+            'identities': {
+                str(identity): labels
+                for identity, labels in list(self.identities.items())
+                if identity not in reserved_identities},
+            'cidrs': self.cidr_names.items(),
+        }
+
+    def load_snapshot(self, snapshot: Dict):
+        """load_snapshot adds what a snapshot contains to the resolver"""
+        for ep_id, podname, labels, ips in snapshot.get('endpoints', []):
+            self.add_endpoint(snapshot_endpoint(ep_id, podname, labels, ips))
+        for identity, labels in snapshot.get('identities', {}).items():
+            self.identities[int(identity)] = self.intern_labels(labels)
+        for cidr, name in snapshot.get('cidrs', []):
+            self.cidr_names.insert(cidr, name)
+        self.changed()
+
+    def changed(self):
+        """changed bumps `generation`, which lets users of the resolver
+        invalidate what they cached from it. It is called after every
+        change, including changes made from other threads.
+        """
+        self.generation += 1
+
+    def cached_ip_key(self, ip) -> int:
+        """cached_ip_key returns ip_key(ip). Events repeat the same
+        addresses, so keys are kept for up to `ip_key_cache_size`
+        addresses, the cache is emptied when it is full.
+        """
+        key = self.ip_keys.get(ip)
+        if key is None:
+            key = ip_key(ip)
+            if len(self.ip_keys) >= self.ip_key_cache_size:
+                self.ip_keys.clear()
+            self.ip_keys[ip] = key
+        return key
 
     def resolve_ip(self, ip) -> str:
-        if ip in self.ip_resolutions:
-            return self.ip_resolutions[ip]
+        key = self.ip_keys.get(ip)
+        if key is None:
+            key = self.cached_ip_key(ip)
+        ep_id = self.ip_resolutions.get(key)
+        if ep_id is not None:
+            # the watch thread can remove the endpoint in between
+            return self.epid_resolutions.get(ep_id, "")
+        if ip and len(self.cidr_names):
+            return self.cidr_names.lookup(ip) or ""
         return ""
 
     def resolve_eid(self, eid) -> str:
-        if eid in self.epid_resolutions:
-            return self.epid_resolutions[eid]
-        return ""
+        try:
+            return self.epid_resolutions.get(int(eid), "")
+        except (TypeError, ValueError):
+            return ""
 
     def resolve_identity(self, id) -> List:
+        """resolve_identity returns labels of the identity, None if they
+        are not known (yet, if there is an identity_source)
+        """
         if id in self.identities:
             return self.identities[id]
-        return ""
+        if self.identity_source is not None and id is not None:
+            return self.identity_source.lookup(id)
+        return None
 
     def resolve_id_from_ip(self, ip) -> str:
-        if ip in self.ip_to_epid_resolutions:
-            return self.ip_to_epid_resolutions[ip]
-        return ""
+        return self.ip_resolutions.get(self.cached_ip_key(ip), "")
 
     def resolve_endpoint_ids(self, selectors: List[str],
                              pod_names: List[str],
                              ips: List[str],
-                             namespace: str) -> Set[int]:
+                             namespace: str,
+                             substring: bool = False) -> Set[int]:
         """resolve_endpoint_ids returns endpoint ids that match
         selectors, pod names and ips provided
         """
         ids = set()
         ids.update(
             self.resolve_endpoint_ids_from_pods(pod_names),
-            self.resolve_endpoint_ids_from_selectors(selectors, namespace),
+            self.resolve_endpoint_ids_from_selectors(selectors, namespace,
+                                                     substring),
             self.resolve_endpoint_ids_from_ips(ips)
         )
         return ids
 
     def resolve_endpoint_ids_from_pods(self, pod_names: List[str]):
-
-        try:
-            namesMatch = {
-                endpoint['id'] for endpoint in self.endpoint_data
-                if
-                get_pod_name(endpoint)
-                in pod_names
-            }
-        except (KeyError, TypeError):
-            # fall back to older API structure
-            namesMatch = {endpoint['id'] for endpoint in self.endpoint_data
-                          if endpoint['pod-name'] in pod_names}
-        return namesMatch
+        return {self.pod_index[name] for name in pod_names
+                if name in self.pod_index}
 
     def resolve_endpoint_ids_from_selectors(self, selectors: List[str],
-                                            namespace: str):
-
-        namespace_matcher = f"k8s:io.kubernetes.pod.namespace={namespace}"
-
-        def labels_match(data, selectors: List[str],
-                         labels_getter: Callable[[Dict], List[str]]):
-            return {
-                endpoint['id'] for endpoint in data
-                if any([
-                    any(
-                        [selector in label
-                         for selector in selectors])
-                    for label
-                    in labels_getter(endpoint)
-                ]) and namespace_matcher in labels_getter(endpoint)
-            }
-
-        getters = [
-                lambda x: x['status']['labels']['security-relevant'],
-                lambda x: x['labels']['orchestration-identity'],
-                lambda x: x['labels']['security-relevant']
-        ]
-        labelsMatch = []
-        for getter in getters:
-            try:
-                labelsMatch = labels_match(
-                  self.endpoint_data, selectors, getter)
-            except (KeyError, TypeError):
-                continue
-            break
-        return labelsMatch
+                                            namespace: str,
+                                            substring: bool = False):
+        """resolve_endpoint_ids_from_selectors returns ids of endpoints in
+        namespace which have a label matching any of the selectors.
+
+        Selectors match labels exactly, "id=app1" matches "k8s:id=app1"
+        and so does "k8s:id=app1". With `substring`, a selector matches
+        all labels containing it.
+        """
+        in_namespace = set()
+        for label in self.label_keys.get(namespace_label + namespace, ()):
+            in_namespace.update(self.label_index[label])
+        if not in_namespace:
+            return set()
+
+        labels = set()
+        for selector in selectors:
+            if substring:
+                labels.update(label for label in self.label_index
+                              if selector in label)
+            elif selector in self.label_index:
+                labels.add(selector)
+            else:
+                labels.update(self.label_keys.get(selector, ()))
+
+        ids = set()
+        for label in labels:
+            ids.update(self.label_index[label])
+        return ids & in_namespace
 
     def resolve_endpoint_ids_from_ips(self, ips: List[str]):
         return {self.resolve_id_from_ip(ip) for ip in ips} - {''}
@@ -0,0 +1,168 @@
+from typing import Dict, Tuple
+import sys
+import threading
+
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.epresolver import compact_endpoint
+
+
+class EndpointWatcher:
+    """EndpointWatcher keeps an EndpointResolver in sync with the
+    CiliumEndpoints in the cluster, so pods created during the session
+    are resolved too.
+
+    It works like a client-go informer: `relist` lists all endpoints and
+    remembers the resourceVersion of the list, the watch thread started
+    by `start` then applies added, modified and deleted endpoints to the
+    resolver one by one. If the watch falls too far behind (410 Gone),
+    endpoints are listed again. A watch which received nothing for
+    `watch_timeout` seconds is restarted from the last seen
+    resourceVersion.
+
+    Endpoints are listed in pages of `page_size`, each page is indexed
+    and freed before the next one is requested. Only the fields used by
+    the resolver are kept. If `namespace` is set, only endpoints of that
+    namespace are listed and watched.
+    """
+    def __init__(self, resolver: EndpointResolver,
+                 crds: client.CustomObjectsApi = None,
+                 retry_interval: float = 5.0,
+                 namespace: str = None,
+                 page_size: int = 500,
+                 watch_timeout: float = 300.0):
+        self.resolver = resolver
+        self.crds = crds or client.CustomObjectsApi()
+        self.retry_interval = retry_interval
+        self.namespace = namespace
+        self.page_size = page_size
+        self.watch_timeout = watch_timeout
+        self.resource_version = None
+        # (namespace, name) of CEP -> endpoint id
+        self.cep_ids = {}
+        self.watch = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.watch is not None:
+            self.watch.stop()
+
+    def list_endpoints(self, **kwargs) -> Dict:
+        if self.namespace is not None:
+            return self.crds.list_namespaced_custom_object(
+                "cilium.io", "v2", self.namespace, "ciliumendpoints",
+                **kwargs)
+        return self.crds.list_cluster_custom_object(
+            "cilium.io", "v2", "ciliumendpoints", **kwargs)
+
+    def relist(self):
+        self.cep_ids = {}
+        token = None
+        while True:
+            resp = self.list_page(token)
+            for cep in resp['items']:
+                self.apply('ADDED', cep)
+            token = resp['metadata'].get('continue')
+            if not token:
+                break
+
+        self.resolver.retain_endpoints(set(self.cep_ids.values()))
+        self.resource_version = resp['metadata']['resourceVersion']
+
+    def list_page(self, token: str = None) -> Dict:
+        """list_page lists one page of endpoints. The continue token
+        expires after a few minutes (410 Gone), listing then starts over.
+
+        The pinned client doesn't accept limit and continue for custom
+        objects, so the request is made with its ApiClient directly.
+        """
+        query = [('limit', self.page_size)]
+        if token:
+            query.append(('continue', token))
+        path = '/apis/cilium.io/v2/ciliumendpoints'
+        path_params = {}
+        if self.namespace is not None:
+            path = '/apis/cilium.io/v2/namespaces/{namespace}/ciliumendpoints'
+            path_params['namespace'] = self.namespace
+        return self.crds.api_client.call_api(
+            path, 'GET', path_params, query,
+            {'Accept': 'application/json'},
+            response_type='object', auth_settings=['BearerToken'],
+            _return_http_data_only=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch_endpoints()
+            except ApiException as e:
+                if e.status == 410:
+                    self.resource_version = None
+                    continue
+                self.stopped.wait(self.retry_interval)
+            except TypeError as e:
+                # the client does not support a call we make, retrying
+                # won't help
+                print(f'endpoint watch stopped: {e}', file=sys.stderr)
+                return
+            except Exception:
+                # connection errors, the watch is restarted from the last
+                # seen resourceVersion
+                self.stopped.wait(self.retry_interval)
+
+    def watch_endpoints(self):
+        # with return_type the watch tracks resourceVersions itself and
+        # resumes from the last one when the server closes the stream.
+        # The pinned client has no timeout_seconds for custom objects, a
+        # client side read timeout ends idle watches instead.
+        self.watch = watch.Watch(return_type='object')
+        events = self.watch.stream(self.list_endpoints,
+                                   resource_version=self.resource_version,
+                                   _request_timeout=self.watch_timeout)
+        for event in events:
+            if self.stopped.is_set():
+                return
+
+            cep = event['object']
+            if event['type'] == 'ERROR':
+                if cep.get('code') == 410:
+                    self.resource_version = None
+                return
+
+            self.apply(event['type'], cep)
+            self.resource_version = cep['metadata']['resourceVersion']
+
+    def apply(self, event_type: str, cep: Dict):
+        key = cep_key(cep)
+        endpoint = None
+        if event_type != 'DELETED':
+            try:
+                endpoint = compact_endpoint(cep['status'])
+            except (KeyError, TypeError):
+                # endpoints which are still being created have no
+                # identity or networking yet, they are added by the
+                # event which completes them
+                pass
+        ep_id = endpoint['id'] if endpoint is not None else None
+
+        old_id = self.cep_ids.pop(key, None)
+        if old_id is not None and old_id != ep_id:
+            self.resolver.remove_endpoint(old_id)
+
+        if endpoint is None:
+            return
+
+        self.cep_ids[key] = ep_id
+        self.resolver.add_endpoint(endpoint)
+
+
+def cep_key(cep: Dict) -> Tuple[str, str]:
+    return (cep['metadata']['namespace'], cep['metadata']['name'])
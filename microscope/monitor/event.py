@@ -0,0 +1,78 @@
+class MonitorEvent:
+    """MonitorEvent is a single parsed `cilium monitor --json` event.
+
+    Events are sent from monitor processes as they are and rendered to text
+    by EventFormatter only when they are printed or shown on screen.
+    Fields which do not apply to the event type are None.
+    """
+
+    __slots__ = (
+        'type',
+        'node',
+        'timestamp',
+        'cpu',
+        'src_ip',
+        'dst_ip',
+        'src_port',
+        'dst_port',
+        'src_ep',
+        'dst_ep',
+        'src_identity',
+        'dst_identity',
+        'src_labels',
+        'dst_labels',
+        'verdict',
+        'reason',
+        'proto',
+        'summary',
+        'message',
+    )
+
+    def __init__(self, type: str, node: str = "", timestamp: float = 0.0,
+                 cpu=None, src_ip=None, dst_ip=None, src_port=None,
+                 dst_port=None, src_ep=None, dst_ep=None, src_identity=None,
+                 dst_identity=None, src_labels=None, dst_labels=None,
+                 verdict=None, reason=None, proto=None, summary=None,
+                 message=None):
+        self.type = type
+        self.node = node
+        self.timestamp = timestamp
+        self.cpu = cpu
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.src_ep = src_ep
+        self.dst_ep = dst_ep
+        self.src_identity = src_identity
+        self.dst_identity = dst_identity
+        self.src_labels = src_labels
+        self.dst_labels = dst_labels
+        self.verdict = verdict
+        self.reason = reason
+        self.proto = proto
+        self.summary = summary
+        self.message = message
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, s) for s in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values: tuple) -> 'MonitorEvent':
+        return cls(*values)
+
+    def __reduce__(self):
+        # pickle as a plain tuple of values, without slot names
+        return (MonitorEvent, self.as_tuple())
+
+    def __eq__(self, other):
+        if not isinstance(other, MonitorEvent):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s)
+                   for s in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{s}={getattr(self, s)!r}"
+                           for s in self.__slots__
+                           if getattr(self, s) is not None)
+        return f"MonitorEvent({fields})"
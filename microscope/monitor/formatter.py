@@ -0,0 +1,214 @@
+from typing import Dict, List, Tuple
+
+from microscope.monitor import jsoncodec
+from microscope.monitor.cache import LRUCache
+from microscope.monitor.event import MonitorEvent
+
+
+class EventFormatter:
+    """EventFormatter renders MonitorEvents to display strings,
+    resolving endpoints with the EndpointResolver.
+
+    Output of raw and verbose processors is already text and is returned
+    unchanged.
+
+    Endpoint representations and identity labels are cached in LRU caches
+    of `cache_size` entries, as the same endpoints show up in most events.
+    The caches are dropped whenever the resolver's generation changes.
+    """
+    def __init__(self, resolver, cache_size: int = 4096):
+        self.resolver = resolver
+        # (ip, port, endpoint id, identity) -> representation
+        self.ep_cache = LRUCache(cache_size)
+        # identity -> labels representation
+        self.identity_cache = LRUCache(cache_size)
+        self.generation = None
+
+    def format(self, event) -> str:
+        if not isinstance(event, MonitorEvent):
+            return event
+
+        if event.type == "logRecord":
+            return self.format_l7(event)
+        if event.type == "trace":
+            return self.format_trace(event)
+        if event.type == "drop":
+            return self.format_drop(event)
+        if event.type == "debug":
+            return self.format_debug(event)
+        if event.type == "capture":
+            return self.format_capture(event)
+        if event.type == "agent":
+            return self.format_agent(event)
+        if event.type == "gap":
+            return self.format_gap(event)
+
+        return event.message
+
+    def parse_labels(self, labels: List[str]) -> str:
+        return ", ".join([label for label in labels
+                          if "k8s:io.kubernetes.pod.namespace=" not in label])
+
+    def format_l7(self, event: MonitorEvent) -> str:
+        src_labels = self.parse_labels(event.src_labels)
+        dst_labels = self.parse_labels(event.dst_labels)
+
+        return (f"({src_labels}) => ({dst_labels}) {event.proto}"
+                f" {event.summary} {event.verdict}")
+
+    def format_trace(self, event: MonitorEvent) -> str:
+        src_ep, dst_ep = self.get_eps_repr(event)
+
+        return (f"trace ({src_ep}) =>"
+                f" ({dst_ep})")
+
+    def format_drop(self, event: MonitorEvent) -> str:
+        src_ep, dst_ep = self.get_eps_repr(event)
+
+        return (f"drop: {event.reason} ({src_ep}) =>"
+                f" ({dst_ep})")
+
+    def format_debug(self, event: MonitorEvent) -> str:
+        return f"debug: {event.message} on {event.cpu}"
+
+    def format_capture(self, event: MonitorEvent) -> str:
+        return f"{event.reason}: {event.summary}"
+
+    def format_agent(self, event: MonitorEvent) -> str:
+        return f"{event.reason}: {event.message}"
+
+    def format_gap(self, event: MonitorEvent) -> str:
+        return (f"-- monitor stream lost for {event.summary:.1f}s, "
+                f"reconnected to {event.message} --")
+
+    def get_eps_repr(self, event: MonitorEvent) -> Tuple[str, str]:
+        """
+        get_eps_repr returns tuple with source endpoint
+        and destination endpoint representation
+        """
+        src_repr = self.get_ep_repr(event.src_ip, event.src_port,
+                                    event.src_ep, event.src_identity)
+
+        dst_repr = self.get_ep_repr(event.dst_ip, event.dst_port,
+                                    event.dst_ep, event.dst_identity)
+        return (src_repr, dst_repr)
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        """cache_stats returns (hits, misses) of the endpoint and identity
+        caches
+        """
+        return {
+            'endpoints': (self.ep_cache.hits, self.ep_cache.misses),
+            'identities': (self.identity_cache.hits,
+                           self.identity_cache.misses)}
+
+    def check_generation(self):
+        generation = self.resolver.generation
+        if generation != self.generation:
+            self.ep_cache.clear()
+            self.identity_cache.clear()
+            self.generation = generation
+
+    def get_ep_repr(self, ip, port, ep_id, identity):
+        self.check_generation()
+        key = (ip, port, ep_id, identity)
+        repr = self.ep_cache.get(key)
+        if repr is None:
+            repr = self.render_ep_repr(ip, port, ep_id, identity)
+            self.ep_cache.put(key, repr)
+        return repr
+
+    def get_identity_repr(self, identity) -> str:
+        repr = self.identity_cache.get(identity)
+        if repr is None:
+            labels = self.resolver.resolve_identity(identity)
+            if labels is not None:
+                repr = self.parse_labels(labels)
+            else:
+                repr = str(identity)
+            self.identity_cache.put(identity, repr)
+        return repr
+
+    def render_ep_repr(self, ip, port, ep_id, identity):
+        ip_l4 = ""
+        repr = ""
+        if ip and port:
+            ip_l4 = ip + ":" + port
+
+        if ip:
+            repr = self.resolver.resolve_ip(ip)
+
+        if not repr:
+            repr = self.resolver.resolve_eid(ep_id)
+
+        if not repr:
+            repr = self.get_identity_repr(identity)
+
+        if ip_l4:
+            repr += f" {ip_l4}"
+        elif ip:
+            repr += f" {ip}"
+
+        return repr
+
+
+class JSONEventFormatter(EventFormatter):
+    """JSONEventFormatter renders events as single line JSON objects with
+    the resolved source and destination, for `--output ndjson`.
+
+    Text output of raw and verbose processors, or events which could not
+    be parsed, become objects of type "text".
+    """
+    fields = ('cpu', 'verdict', 'reason', 'proto', 'summary', 'message')
+
+    def format(self, event, node: str = "") -> str:
+        return jsoncodec.encode(self.to_record(event, node))
+
+    def to_record(self, event, node: str = "") -> Dict:
+        if not isinstance(event, MonitorEvent):
+            return {'node': node, 'type': 'text', 'message': event}
+
+        record = {'node': event.node or node,
+                  'timestamp': event.timestamp,
+                  'type': event.type}
+        if event.type == "gap":
+            # gap events keep the seconds lost in summary and the pod
+            # reconnected to in message, summary is a string elsewhere
+            record['gap_seconds'] = event.summary
+            record['pod'] = event.message
+            return record
+        for field in self.fields:
+            value = getattr(event, field)
+            if value is not None:
+                record[field] = value
+
+        if event.type in ("trace", "drop", "logRecord"):
+            record['src'] = self.endpoint_record(
+                event.src_ip, event.src_port, event.src_ep,
+                event.src_identity, event.src_labels)
+            record['dst'] = self.endpoint_record(
+                event.dst_ip, event.dst_port, event.dst_ep,
+                event.dst_identity, event.dst_labels)
+        return record
+
+    def endpoint_record(self, ip, port, ep_id, identity, labels) -> Dict:
+        record = {}
+        name = ""
+        if ip:
+            record['ip'] = ip
+            name = self.resolver.resolve_ip(ip)
+        if port:
+            record['port'] = port
+        if ep_id:
+            record['endpoint'] = ep_id
+            if not name:
+                name = self.resolver.resolve_eid(ep_id)
+        if name:
+            record['name'] = name
+        if identity is not None:
+            record['identity'] = identity
+            if labels is None:
+                labels = self.resolver.resolve_identity(identity)
+        if labels:
+            record['labels'] = labels
+        return record
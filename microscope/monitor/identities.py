@@ -0,0 +1,147 @@
+from typing import Callable, Dict, List, Optional, Set
+import itertools
+import threading
+
+from microscope.monitor.cache import LRUCache
+
+
+class IdentityCache:
+    """IdentityCache resolves numeric security identities which are not
+    used by any listed endpoint, e.g. identities of CIDR peers or of
+    remote clusters, from CiliumIdentity objects.
+
+    `lookup` never blocks. An identity which is not cached yet is queued
+    and None is returned, the background thread started by `start` then
+    fetches the identities queued within `batch_delay` seconds. Up to
+    `max_gets` of them are fetched one by one with `get_identity`, so
+    identities evicted from a full cache don't list the whole cluster
+    again. Larger batches, e.g. at startup, are fetched with a single
+    call to `list_identities` and the other listed identities are cached
+    too, up to `maxsize`. Events shown later find them in the cache.
+
+    list_identities: returns a list of CiliumIdentity objects, like
+                     CustomObjectsApi.list_cluster_custom_object
+    get_identity: returns the CiliumIdentity of a name, None if it does
+                  not exist. Without it, every batch is listed
+    ttl: seconds an identity is cached, identities are not reused but
+         can be deleted
+    negative_ttl: seconds until an identity which could not be found, or
+                  whose fetch failed, is looked up again
+    on_update: called from the fetch thread when identities were added
+    """
+    def __init__(self, list_identities: Callable[[], Dict],
+                 get_identity: Callable[[str], Optional[Dict]] = None,
+                 maxsize: int = 4096, ttl: float = 600.0,
+                 negative_ttl: float = 30.0, batch_delay: float = 0.05,
+                 max_gets: int = 16,
+                 on_update: Callable[[], None] = None):
+        self.list_identities = list_identities
+        self.get_identity = get_identity
+        self.max_gets = max_gets
+        self.cache = LRUCache(maxsize, ttl)
+        self.negative_ttl = negative_ttl
+        self.batch_delay = batch_delay
+        self.on_update = on_update
+        self.lock = threading.Lock()
+        # identities to fetch, and identities being fetched
+        self.pending = set()
+        self.fetching = set()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def lookup(self, identity: int) -> List[str]:
+        """lookup returns the labels of identity, None if they are not
+        known yet or the identity does not exist
+        """
+        with self.lock:
+            labels = self.cache.get(identity, self)
+            if labels is not self:
+                return labels
+            if identity not in self.fetching:
+                self.pending.add(identity)
+                self.wakeup.set()
+        return None
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            # let misses of concurrent events pile up into one batch
+            if self.stopped.wait(self.batch_delay):
+                return
+
+            with self.lock:
+                self.wakeup.clear()
+                ids = self.pending
+                self.pending = set()
+                self.fetching = ids
+
+            try:
+                found = self.fetch(ids)
+            except Exception:
+                found = {}
+
+            with self.lock:
+                self.store(ids, found)
+                self.fetching = set()
+
+            if found and self.on_update is not None:
+                self.on_update()
+
+    def store(self, ids: Set[int], found: Dict[int, List[str]]):
+        """store caches the listed identities, so later lookups don't list
+        again. The requested ones are put last, they stay cached if the
+        listing is larger than the cache.
+        """
+        room = max(0, self.cache.maxsize - len(ids))
+        others = (identity for identity in found if identity not in ids)
+        for identity in itertools.islice(others, room):
+            self.cache.put(identity, found[identity])
+        for identity in ids:
+            labels = found.get(identity)
+            if labels is None:
+                self.cache.put(identity, None, self.negative_ttl)
+            else:
+                self.cache.put(identity, labels)
+
+    def fetch(self, ids: Set[int]) -> Dict[int, List[str]]:
+        """fetch returns labels of the identities found, a listing also
+        returns identities which were not asked for
+        """
+        if self.get_identity is None or len(ids) > self.max_gets:
+            return self.fetch_all()
+        found = {}
+        for identity in ids:
+            obj = self.get_identity(str(identity))
+            if obj is not None:
+                found[identity] = identity_labels(obj)
+        return found
+
+    def fetch_all(self) -> Dict[int, List[str]]:
+        """fetch_all returns labels of all identities, bypassing the
+        cache
+        """
+        found = {}
+        for obj in self.list_identities()['items']:
+            try:
+                identity = int(obj['metadata']['name'])
+            except (KeyError, ValueError):
+                continue
+            found[identity] = identity_labels(obj)
+        return found
+
+
+def identity_labels(obj: Dict) -> List[str]:
+    """identity_labels returns labels of a CiliumIdentity in the format
+    endpoints use, e.g. "k8s:app=foo"
+    """
+    labels = obj.get('security-labels') or {}
+    return sorted(f"{key}={value}" if value else key
+                  for key, value in labels.items())
@@ -0,0 +1,93 @@
+"""jsoncodec decodes `cilium monitor --json` events straight out of the
+receive buffer of JSONEventFramer.
+
+orjson is used when it is installed, as it can parse a memoryview of the
+buffer without copying it. Otherwise the standard library decoder is used
+with `raw_decode`, which parses consecutive events from one decoded string
+at increasing offsets.
+
+`encode` serializes output records with the same backend.
+"""
+import json
+from typing import List, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+stdlib_decoder = json.JSONDecoder(strict=False)
+stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+backend = "orjson" if orjson is not None else "stdlib"
+
+
+def use_backend(name: str):
+    """use_backend selects the decoder used by decode_frames,
+    either "orjson" or "stdlib"
+    """
+    global backend
+    if name not in ("orjson", "stdlib"):
+        raise ValueError(f"unknown JSON backend {name}")
+    if name == "orjson" and orjson is None:
+        raise ValueError("orjson is not installed")
+    backend = name
+
+
+def decode_frames(buffer: bytearray, frames: List[Tuple[int, int]]) -> List:
+    """decode_frames decodes objects located at (start, end) byte offsets
+    of buffer. Frames which are not valid JSON are returned as strings.
+    """
+    if backend == "orjson":
+        return decode_frames_orjson(buffer, frames)
+    return decode_frames_stdlib(buffer, frames)
+
+
+def encode(obj) -> str:
+    """encode serializes obj to a single line of JSON"""
+    if backend == "orjson":
+        return orjson.dumps(obj).decode()
+    return stdlib_encoder.encode(obj)
+
+
+def decode_frame_stdlib(buffer: bytearray, start: int, end: int):
+    text = buffer[start:end].decode(errors="replace")
+    try:
+        return stdlib_decoder.decode(text)
+    except ValueError:
+        return text
+
+
+def decode_frames_orjson(buffer: bytearray,
+                         frames: List[Tuple[int, int]]) -> List:
+    events = []
+    with memoryview(buffer) as view:
+        for start, end in frames:
+            try:
+                events.append(orjson.loads(view[start:end]))
+            except orjson.JSONDecodeError:
+                # orjson is strict about control characters in strings,
+                # `cilium monitor` is not
+                events.append(decode_frame_stdlib(buffer, start, end))
+    return events
+
+
+def decode_frames_stdlib(buffer: bytearray,
+                         frames: List[Tuple[int, int]]) -> List:
+    # Frames start with "{" and end with "}", so they never split a
+    # multibyte character and the region can be decoded at once. There is
+    # no "{" between frames, so the next one is found with str.find.
+    with memoryview(buffer) as view:
+        text = str(view[frames[0][0]:frames[-1][1]], "utf-8", "replace")
+    events = []
+    idx = 0
+    for start, end in frames:
+        idx = text.find("{", idx)
+        try:
+            event, idx = stdlib_decoder.raw_decode(text, idx)
+        except ValueError:
+            event = buffer[start:end].decode(errors="replace")
+            idx += len(event)
+        events.append(event)
+    return events
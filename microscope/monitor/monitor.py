@@ -1,15 +1,22 @@
 from typing import List
+import random
+import select
 import signal
-import threading
+import sys
+import time
 from multiprocessing import Process, Queue
+from multiprocessing.connection import Connection
 
 from kubernetes.client.apis import core_v1_api
-from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream
+from websocket import WebSocketException
 
+from microscope.monitor.event import MonitorEvent
 from microscope.monitor.parser import MonitorOutputProcessorVerbose
 from microscope.monitor.parser import MonitorOutputProcessorJSON
 from microscope.monitor.parser import MonitorOutputProcessorSimple
+from microscope.monitor.transport import BatchSender
+from microscope.monitor.recorder import SegmentRecorder
 
 
 # we are ignoring sigint in monitor processes as they are closed via queue
@@ -17,6 +24,30 @@ def sigint_in_monitor(signum, frame):
     pass
 
 
+class Backoff:
+    """Backoff computes jittered exponential delays between reconnects.
+    Delays double from `base` up to `cap` seconds and are picked randomly
+    from the upper half of that range, so monitors of many nodes don't
+    reconnect in lockstep after an api server restart.
+    """
+    def __init__(self, base: float = 1.0, cap: float = 60.0,
+                 stable_after: float = 30.0):
+        self.base = base
+        self.cap = cap
+        # a connection which lasted this many seconds resets the delay
+        self.stable_after = stable_after
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+    def connection_lasted(self, seconds: float):
+        if seconds >= self.stable_after:
+            self.attempt = 0
+
+
 class Monitor:
     def __init__(self,
                  pod_name: str,
@@ -24,79 +55,176 @@ class Monitor:
                  namespace: str,
                  queue: Queue,
                  close_queue: Queue,
+                 shutdown: Connection,
                  api: core_v1_api.CoreV1Api,
                  cmd: List[str],
                  mode: str,
-                 resolver
+                 drop_policy: str = 'block',
+                 reconnect: bool = False,
+                 record_dir: str = None
                  ):
         self.pod_name = pod_name
         self.node_name = node_name
         self.namespace = namespace
         self.queue = queue
         self.close_queue = close_queue
+        self.shutdown = shutdown
         self.api = api
         self.cmd = cmd
         self.mode = mode
-        self.resolver = resolver
+        self.drop_policy = drop_policy
+        self.reconnect = reconnect
+        # raw JSON output is recorded to record_dir, across reconnects
+        self.record_dir = record_dir
+        self.recorder = None
 
         self.process = Process(target=self.connect)
-        self.output = node_name + "\n"
-        self.output_lock = threading.Semaphore()
 
-    def connect(self):
-        try:
-            resp = self.api.read_namespaced_pod(name=self.pod_name,
-                                                namespace=self.namespace)
-        except ApiException as e:
-            if e.status != 404:
-                print('Unknown error: %s' % e)
-                exit(1)
+    def open_stream(self, api: core_v1_api.CoreV1Api = None):
+        """open_stream starts the monitor command in the Cilium pod
+        and returns the exec websocket client
+        """
+        if api is None:
+            api = self.api
 
         # calling exec and wait for response.
 
-        resp = stream(self.api.connect_get_namespaced_pod_exec, self.pod_name,
+        return stream(api.connect_get_namespaced_pod_exec, self.pod_name,
                       self.namespace,
                       command=["bash", "-c", " ".join(self.cmd)],
                       stderr=True, stdin=True,
                       stdout=True, tty=True,
                       _preload_content=False)
 
-        signal.signal(signal.SIGINT, sigint_in_monitor)
-
+    def create_processor(self):
         if self.mode == "":
-            processor = MonitorOutputProcessorJSON(self.resolver)
+            return MonitorOutputProcessorJSON(self.node_name, self.recorder)
         elif self.mode == "raw":
-            processor = MonitorOutputProcessorSimple()
+            return MonitorOutputProcessorSimple()
         else:
-            processor = MonitorOutputProcessorVerbose()
-
-        while resp.is_open():
-            for msg in processor:
-                if msg:
-                    self.queue.put({
-                        'name': self.pod_name,
-                        'node_name': self.node_name,
-                        'output': msg})
-
-            resp.update(timeout=1)
-            if not self.close_queue.empty():
-                print("Closing monitor")
-                resp.write_stdin('\x03')
-                break
-            if resp.peek_stdout():
-                processor.add_out(resp.read_stdout())
-            if resp.peek_stderr():
-                processor.add_err(resp.read_stderr())
+            return MonitorOutputProcessorVerbose()
+
+    def create_sender(self, blocking: bool = True) -> BatchSender:
+        return BatchSender(self.queue, self.pod_name, self.node_name,
+                           policy=self.drop_policy, shutdown=self.shutdown,
+                           blocking=blocking)
+
+    def open_recorder(self):
+        if self.record_dir and self.mode == "":
+            self.recorder = SegmentRecorder(self.record_dir, self.node_name)
+
+    def close_recorder(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def resolve_pod(self, api: core_v1_api.CoreV1Api = None):
+        """resolve_pod finds the running Cilium pod on the monitor's node,
+        which changes when Cilium pods are rolled out
+        """
+        if api is None:
+            api = self.api
+
+        pods = api.list_namespaced_pod(
+            self.namespace, label_selector='k8s-app=cilium',
+            field_selector=f'spec.nodeName={self.node_name}')
+        running = [pod.metadata.name for pod in pods.items
+                   if pod.status.phase == 'Running']
+        if running and self.pod_name not in running:
+            self.pod_name = running[0]
+
+    def gap_event(self, lost_at: float) -> MonitorEvent:
+        """gap_event marks output missing while the stream was down"""
+        now = time.time()
+        return MonitorEvent("gap", self.node_name, now,
+                            summary=now - lost_at, message=self.pod_name)
 
-        for msg in processor:
-            if msg:
-                self.queue.put({
-                    'name': self.pod_name,
-                    'node_name': self.node_name,
-                    'output': msg})
+    def connect(self):
+        signal.signal(signal.SIGINT, sigint_in_monitor)
 
-        resp.close()
+        sender = self.create_sender()
+        self.open_recorder()
+        backoff = Backoff()
+        lost_at = None
+
+        while True:
+            try:
+                resp = self.open_stream()
+            except Exception as e:
+                if lost_at is None:
+                    print(f'Could not start monitor on {self.pod_name}: {e}',
+                          file=sys.stderr)
+                    break
+                resp = None
+
+            if resp is not None:
+                if lost_at is not None:
+                    sender.add(self.gap_event(lost_at))
+                connected_at = time.time()
+                closing = self.follow(resp, sender)
+                if closing or not self.reconnect:
+                    break
+                lost_at = time.time()
+                backoff.connection_lasted(lost_at - connected_at)
+
+            if self.shutdown.poll(backoff.next_delay()):
+                break
+            try:
+                self.resolve_pod()
+            except Exception:
+                # retried on the next reconnect attempt
+                pass
+
+        sender.close()
+        self.close_recorder()
 
         self.close_queue.cancel_join_thread()
         self.queue.close()
         self.queue.join_thread()
+
+    def follow(self, resp, sender: BatchSender) -> bool:
+        """follow forwards output of the exec stream until it ends. Returns
+        True if it ended because the monitor is shutting down.
+        """
+        processor = self.create_processor()
+        closing = False
+
+        # Block until the websocket or the shutdown pipe is readable.
+        # The processor can ask to be polled earlier when it holds back
+        # a partial message, the sender when it holds back frames.
+        sock = resp.sock.sock
+        try:
+            while resp.is_open():
+                timeout = sender.wait_timeout(processor.wait_timeout())
+                readable, _, _ = select.select([sock, self.shutdown], [], [],
+                                               timeout)
+                if self.shutdown in readable:
+                    print("Closing monitor", file=sys.stderr)
+                    closing = True
+                    resp.write_stdin('\x03')
+                    break
+                if readable:
+                    resp.update(timeout=0)
+                else:
+                    processor.on_idle()
+                if resp.peek_stdout():
+                    processor.add_out(resp.read_stdout())
+                if resp.peek_stderr():
+                    processor.add_err(resp.read_stderr())
+
+                for msg in processor:
+                    if msg:
+                        sender.add(msg)
+                sender.flush()
+        except (WebSocketException, OSError):
+            # connection lost, the caller decides whether to reconnect
+            pass
+
+        processor.on_idle()
+        for msg in processor:
+            if msg:
+                sender.add(msg)
+        sender.flush()
+
+        resp.close()
+        return closing
@@ -1,117 +1,324 @@
-import queue as queuemodule
+import re
 import time
 import json
-from typing import List, Dict, Tuple
+from collections import deque
+from typing import List, Dict, Tuple, Optional, Union, Iterator
+
+from microscope.monitor import jsoncodec
+from microscope.monitor.event import MonitorEvent
+
+
+class LineAssembler:
+    """LineAssembler splits chunks of stream output into lines. The last
+    line of a chunk is held back until a later chunk completes it or
+    `flush` is called, so lines split across websocket frames come out
+    whole.
+
+    Only the monitor's read loop uses it, so complete lines are appended
+    to a plain list which `drain` swaps for an empty one.
+    """
+    def __init__(self):
+        self.partial = ""
+        self.lines = []
+
+    def feed(self, chunk: str):
+        lines = chunk.split("\n")
+        lines[0] = self.partial + lines[0]
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ""
+
+    def drain(self) -> List[str]:
+        """drain returns all complete lines"""
+        lines = self.lines
+        self.lines = []
+        return lines
 
 
 class MonitorOutputProcessorSimple:
+    """MonitorOutputProcessorSimple passes output through line by line.
+
+    Iterating the processor yields all lines completed so far. A trailing
+    partial line is yielded once the stream has been idle for
+    `idle_timeout` seconds, the read loop calls `on_idle` then.
+    """
+    idle_timeout = 0.2
+
     def __init__(self):
-        self.std_output = queuemodule.Queue()
-        self.std_err = queuemodule.Queue()
+        self.std_output = LineAssembler()
+        self.std_err = LineAssembler()
 
     def add_out(self, out: str):
-        for line in out.split("\n"):
-            self.std_output.put(line)
+        self.std_output.feed(out)
 
     def add_err(self, err: str):
-        for line in err.split("\n"):
-            self.std_err.put(line)
+        self.std_err.feed(err)
 
     def get_err(self) -> str:
-        err = []
-        while not self.std_err.empty():
-            line = self.std_err.get()
-            err.append(line)
+        self.std_err.flush()
+        err = self.std_err.drain()
         if err:
             return "\n".join(err)
 
-    def __iter__(self):
-        return self
+    def wait_timeout(self) -> Optional[float]:
+        """wait_timeout returns how many seconds the stream read loop can
+        wait for new data before the processor has to be polled again,
+        or None if it can wait indefinitely
+        """
+        if self.std_output.partial:
+            return self.idle_timeout
+        return None
+
+    def on_idle(self):
+        """on_idle is called by the read loop when no data arrived within
+        `wait_timeout`, and when the stream ends
+        """
+        self.std_output.flush()
 
-    def __next__(self) -> str:
+    def __iter__(self):
         err = self.get_err()
         if err:
-            return err
-
-        try:
-            return self.std_output.get_nowait()
-        except queuemodule.Empty:
-            raise StopIteration
-
-        raise StopIteration
+            yield err
+        yield from self.std_output.drain()
 
 
 class MonitorOutputProcessorVerbose(MonitorOutputProcessorSimple):
+    """MonitorOutputProcessorVerbose groups `cilium monitor -v` output into
+    messages. The monitor prints a separator line before every message,
+    so a message is complete when the next separator arrives.
+
+    The last message before a pause has no separator after it. It is
+    ended when the stream goes idle: the read loop calls `on_idle` when
+    no data arrived within `wait_timeout()`. The idle timeout adapts to
+    the stream, it is `idle_factor` times the average gap between reads
+    which continued a message, within `min_idle` and `max_idle` seconds.
+    If a message was ended too early, the late gap raises the average.
+
+    The clock is read once per received chunk.
+    """
+    separator = '---'
+    min_idle = 0.02
+    max_idle = 0.5
+    idle_factor = 4
+
     def __init__(self):
-        self.std_output = queuemodule.Queue()
-        self.std_err = queuemodule.Queue()
+        super().__init__()
         self.current_msg = []
-        self.last_event_wait_timeout = 1500
-        self.last_event_time = 0
+        self.ready = []
+        # average gap in seconds between reads within a message
+        self.gap = self.max_idle / self.idle_factor
+        self.last_read = 0.0
+        self.ended_on_idle = False
+
+    def add_out(self, out: str):
+        now = time.monotonic()
+        continues = (self.std_output.partial
+                     or not out.startswith(self.separator))
+        if continues and self.ended_on_idle:
+            # the previous message was cut off, wait longer next time
+            self.gap = max(self.gap, now - self.last_read)
+        elif continues and (self.current_msg or self.std_output.partial):
+            self.gap += (min(now - self.last_read, self.max_idle)
+                         - self.gap) / 8
+        self.last_read = now
+        self.ended_on_idle = False
+        super().add_out(out)
+
+    def process(self, lines: List[str]):
+        for line in lines:
+            if line.startswith(self.separator):
+                if self.current_msg:
+                    self.ready.append(self.pop_current())
+                self.current_msg = [line]
+            else:
+                self.current_msg.append(line)
+
+    def wait_timeout(self) -> Optional[float]:
+        if not (self.current_msg or self.std_output.lines
+                or self.std_output.partial):
+            return None
+        return min(self.max_idle,
+                   max(self.min_idle, self.gap * self.idle_factor))
 
-    def __next__(self) -> str:
+    def on_idle(self):
+        self.std_output.flush()
+        self.process(self.std_output.drain())
+        if self.current_msg:
+            self.ready.append(self.pop_current())
+            self.ended_on_idle = True
+
+    def __iter__(self):
         err = self.get_err()
         if err:
-            return err
+            yield err
 
-        prev_event = self.last_event_time
-        while not self.std_output.empty():
-            line = self.std_output.get()
+        self.process(self.std_output.drain())
+        ready = self.ready
+        self.ready = []
+        yield from ready
 
-            self.last_event_time = int(round(time.time() * 1000))
+    def pop_current(self) -> str:
+        msg = "\n".join(self.current_msg)
+        self.current_msg = []
+        return msg
 
-            if '---' in line:
-                return self.pop_current(line)
-            else:
-                self.current_msg.append(line)
 
-        now = int(round(time.time() * 1000))
-        if prev_event + self.last_event_wait_timeout < now:
-            if self.current_msg:
-                return self.pop_current()
+class JSONEventFramer:
+    """JSONEventFramer splits a stream of concatenated JSON objects
+    into complete top-level objects.
 
-        raise StopIteration
+    Scan position, brace depth and string state are kept between `feed`
+    calls, so every received byte is inspected once. Braces inside string
+    literals are ignored and backslash escapes are honoured. Anything
+    outside of a top-level object (e.g. status lines printed by
+    `cilium monitor` on startup) is skipped.
+    """
 
-    def pop_current(self, init: str = "") -> str:
-        tmp = "\n".join(self.current_msg)
-        if init:
-            self.current_msg = [init]
-        else:
-            self.current_msg = []
-        return tmp
+    # skips everything up to the next brace outside of a string literal;
+    # stops at an opening quote if the string is not terminated yet
+    object_body = re.compile(rb'(?:[^{}"]+|"[^"\\]*(?:\\.[^"\\]*)*")*',
+                             re.DOTALL)
+    string_special = re.compile(rb'["\\]')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # offset of the next byte to scan
+        self.pos = 0
+        # offset of the opening brace of the current object, -1 if none
+        self.start = -1
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, data: bytes):
+        self.compact()
+        self.buffer += data
+
+    def compact(self):
+        """compact drops bytes which are no longer needed from the front
+        of the buffer. Deleting from the front of a bytearray does not
+        move the remaining data, so this is cheap.
+        """
+        consumed = self.start if self.start >= 0 else self.pos
+        if consumed:
+            del self.buffer[:consumed]
+            self.pos -= consumed
+            if self.start >= 0:
+                self.start -= consumed
+
+    def next_frame(self) -> Optional[Tuple[int, int]]:
+        """next_frame returns (start, end) offsets of the next complete
+        object in `buffer`, or None if there is none yet. Offsets are valid
+        until the next `feed` call.
+        """
+        buf = self.buffer
+        size = len(buf)
+        pos = self.pos
+
+        while pos < size:
+            if self.in_string:
+                m = self.string_special.search(buf, pos)
+                if m is None:
+                    pos = size
+                    break
+                i = m.start()
+                if buf[i] == 0x5c:  # backslash, skip escaped byte
+                    pos = i + 2
+                    continue
+                self.in_string = False
+                pos = i + 1
+            elif self.depth == 0:
+                i = buf.find(b'{', pos)
+                if i < 0:
+                    pos = size
+                    break
+                self.start = i
+                self.depth = 1
+                pos = i + 1
+            else:
+                pos = self.object_body.match(buf, pos).end()
+                if pos >= size:
+                    break
+                c = buf[pos]
+                pos += 1
+                if c == 0x22:  # "
+                    self.in_string = True
+                elif c == 0x7b:  # {
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        start = self.start
+                        self.start = -1
+                        self.pos = pos
+                        return (start, pos)
+
+        # pos can point past the end if the buffer ends with a backslash
+        # inside a string; it will be valid after the next feed
+        self.pos = pos
+        return None
 
 
 class MonitorOutputProcessorJSON(MonitorOutputProcessorSimple):
-    def __init__(self, resolver):
-        self.std_output = ""
-        self.std_err = queuemodule.Queue()
-        self.resolver = resolver
+    """MonitorOutputProcessorJSON parses `cilium monitor --json` output
+    into MonitorEvents. Events which cannot be parsed are returned as text.
+
+    If `recorder` is set, the raw events are also passed to its
+    `write_frames` before they are decoded.
+    """
+    def __init__(self, node: str = "", recorder=None):
+        self.framer = JSONEventFramer()
+        self.std_err = LineAssembler()
+        self.node = node
+        self.recorder = recorder
+        self.events = deque()
+        self.timestamp = 0.0
 
     def add_out(self, out: str):
-        self.std_output += out
-
-    def get_event(self) -> str:
-        stack = []
-        opening = 0
-        closing = 0
-
-        for i, c in enumerate(self.std_output):
-            if c == "{":
-                stack.append(i)
-            if c == "}":
-                opening = stack.pop()
-                if len(stack) == 0:
-                    closing = i
-                    break
-        if closing > opening:
-            ret = self.std_output[opening:closing+1]
-            self.std_output = self.std_output[closing+1:]
-            return ret
-        else:
+        self.framer.feed(out.encode())
+
+    def get_event(self) -> Optional[str]:
+        frame = self.framer.next_frame()
+        if frame is None:
             return None
+        start, end = frame
+        return self.framer.buffer[start:end].decode()
 
-    def parse_event(self, e: str) -> str:
-        event = json.loads(e, strict=False)
+    def get_events(self) -> List:
+        """get_events frames and decodes all complete events in the
+        receive buffer in one pass. Events which are not valid JSON are
+        returned as strings.
+        """
+        frames = []
+        frame = self.framer.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.framer.next_frame()
+        if not frames:
+            return []
+        if self.recorder is not None:
+            self.recorder.write_frames(self.timestamp, self.framer.buffer,
+                                       frames)
+        return jsoncodec.decode_frames(self.framer.buffer, frames)
+
+    def parse_recording(self, data: bytes) -> Iterator[
+            Union[MonitorEvent, str]]:
+        """parse_recording parses events recorded by SegmentRecorder.
+        Events are stamped with the receive time recorded before them.
+        """
+        self.framer.feed(data)
+        for event in self.get_events():
+            if isinstance(event, dict) and event.get("type") == "timestamp":
+                self.timestamp = event["timestamp"]
+                continue
+            yield self.parse_event(event)
+
+    def parse_event(self, event) -> Union[MonitorEvent, str]:
+        if not isinstance(event, dict):
+            return event
 
         if event["type"] == "logRecord":
             return self.parse_l7(event)
@@ -126,16 +333,10 @@ class MonitorOutputProcessorJSON(MonitorOutputProcessorSimple):
         if event["type"] == "agent":
             return self.parse_agent(event)
 
-        return e
-
-    def parse_labels(self, labels: List[str]) -> str:
-        return ", ".join([l for l in labels
-                          if "k8s:io.kubernetes.pod.namespace=" not in l])
-
-    def parse_l7(self, event: Dict) -> str:
-        src_labels = self.parse_labels(event["srcEpLabels"])
-        dst_labels = self.parse_labels(event["dstEpLabels"])
+        return MonitorEvent(event["type"], self.node, self.timestamp,
+                            message=json.dumps(event))
 
+    def parse_l7(self, event: Dict) -> MonitorEvent:
         action = ""
         if "http" in event:
             http = event['http']
@@ -145,88 +346,65 @@ class MonitorOutputProcessorJSON(MonitorOutputProcessorSimple):
             kafka = event['kafka']
             action = f"{kafka['APIKey']} {kafka['Topic']['Topic']}"
 
-        return (f"({src_labels}) => ({dst_labels}) {event['l7Proto']}"
-                f" {action} {event['verdict']}")
-
-    def parse_trace(self, event: Dict) -> str:
-        src_ep, dst_ep = self.get_eps_repr(event)
-
-        return (f"trace ({src_ep}) =>"
-                f" ({dst_ep})")
-
-    def parse_drop(self, event: Dict) -> str:
-        src_ep, dst_ep = self.get_eps_repr(event)
-
-        return (f"drop: {event['reason']} ({src_ep}) =>"
-                f" ({dst_ep})")
-
-    def parse_debug(self, event: Dict) -> str:
-        return f"debug: {event['message']} on {event['cpu']}"
-
-    def parse_capture(self, event: Dict) -> str:
-        return f"{event['prefix']}: {event['summary']}"
-
-    def parse_agent(self, event: Dict) -> str:
-        return f"{event['subtype']}: {event['message']}"
-
-    def get_eps_repr(self, event: Dict) -> Tuple[str, str]:
-        """
-        get_eps_repr returns tuple with source endpoint
-        and destination endpoint representation
-        """
-        src_repr = ""
-        dst_repr = ""
-        src_ip = ""
-        dst_ip = ""
-        src_port = ""
-        dst_port = ""
+        return MonitorEvent(
+            event["type"], self.node, self.timestamp,
+            src_ep=event.get("srcEpID"),
+            dst_ep=event.get("dstEpID"),
+            src_identity=event.get("srcIdentity"),
+            dst_identity=event.get("DstIdentity"),
+            src_labels=event["srcEpLabels"],
+            dst_labels=event["dstEpLabels"],
+            verdict=event["verdict"],
+            proto=event["l7Proto"],
+            summary=action)
+
+    def parse_trace(self, event: Dict) -> MonitorEvent:
+        return self.parse_datapath(event)
+
+    def parse_drop(self, event: Dict) -> MonitorEvent:
+        return self.parse_datapath(event, event['reason'])
+
+    def parse_datapath(self, event: Dict, reason: str = None) -> MonitorEvent:
+        """parse_datapath parses trace and drop events"""
+        src_ip = None
+        dst_ip = None
+        src_port = None
+        dst_port = None
 
         try:
             src_ip, dst_ip = self.get_ips(event)
-        except (KeyError, StopIteration):
-            pass
-        try:
-            src_ip, dst_ip = self.get_ips(event)
-        except KeyError:
+        except (KeyError, TypeError):
             pass
 
         try:
             src_port, dst_port = self.get_ports(event)
-        except (KeyError, StopIteration):
+        except (KeyError, TypeError):
             pass
 
-        src_repr = self.get_ep_repr(src_ip, src_port, event.get("source"),
-                                    event.get("srcLabel"))
-
-        dst_repr = self.get_ep_repr(dst_ip, dst_port, event.get("dstID"),
-                                    event.get("dstLabel"))
-        return (src_repr, dst_repr)
-
-    def get_ep_repr(self, ip, port, ep_id, identity):
-        ip_l4 = ""
-        repr = ""
-        if ip and port:
-            ip_l4 = ip + ":" + port
-
-        if ip:
-            repr = self.resolver.resolve_ip(ip)
-
-        if not repr:
-            repr = self.resolver.resolve_eid(ep_id)
-
-        if not repr:
-            labels = self.resolver.resolve_identity(identity)
-            if labels is not None:
-                repr = self.parse_labels(labels)
-            else:
-                repr = str(identity)
-
-        if ip_l4:
-            repr += f" {ip_l4}"
-        elif ip:
-            repr += f" {ip}"
-
-        return repr
+        return MonitorEvent(
+            event["type"], self.node, self.timestamp,
+            cpu=event.get("cpu"),
+            src_ip=src_ip,
+            dst_ip=dst_ip,
+            src_port=src_port,
+            dst_port=dst_port,
+            src_ep=event.get("source"),
+            dst_ep=event.get("dstID"),
+            src_identity=event.get("srcLabel"),
+            dst_identity=event.get("dstLabel"),
+            reason=reason)
+
+    def parse_debug(self, event: Dict) -> MonitorEvent:
+        return MonitorEvent(event["type"], self.node, self.timestamp,
+                            cpu=event['cpu'], message=event['message'])
+
+    def parse_capture(self, event: Dict) -> MonitorEvent:
+        return MonitorEvent(event["type"], self.node, self.timestamp,
+                            reason=event['prefix'], summary=event['summary'])
+
+    def parse_agent(self, event: Dict) -> MonitorEvent:
+        return MonitorEvent(event["type"], self.node, self.timestamp,
+                            reason=event['subtype'], message=event['message'])
 
     def get_ips(self, event: Dict) -> Tuple[str, str]:
         return (event["summary"]["l3"]["src"], event["summary"]["l3"]["dst"])
@@ -234,16 +412,27 @@ class MonitorOutputProcessorJSON(MonitorOutputProcessorSimple):
     def get_ports(self, event: Dict) -> Tuple[str, str]:
         return (event["summary"]["l4"]["src"], event["summary"]["l4"]["dst"])
 
-    def __next__(self) -> str:
+    def wait_timeout(self) -> Optional[float]:
+        return None
+
+    def on_idle(self):
+        # events are complete JSON objects, there is nothing to flush
+        pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Union[MonitorEvent, str]:
         err = self.get_err()
         if err:
             return err
 
-        if not self.std_output:
-            raise StopIteration
-
-        event = self.get_event()
-        if event is None:
-            raise StopIteration
+        if not self.events:
+            # cilium monitor does not timestamp events, so they are stamped
+            # once per received batch
+            self.timestamp = time.time()
+            self.events.extend(self.get_events())
+            if not self.events:
+                raise StopIteration
 
-        return self.parse_event(event)
+        return self.parse_event(self.events.popleft())
@@ -0,0 +1,199 @@
+"""recorder writes the raw `cilium monitor --json` output of a node into
+compressed segments, for replaying it later.
+
+A recording of a node consists of two files in the recording directory:
+
+<node>.json.gz (or .json.zst): segments, each a complete gzip member (or
+    zstd frame), appended one after another. A segment holds events as
+    they were received, each batch preceded by a
+    {"type": "timestamp", "timestamp": ...} object with its receive time.
+<node>.index: one JSON object per sealed segment with its node, first
+    and last timestamp, byte offset and length in the segment file,
+    number of events and codec.
+
+The directory also holds endpoints.json, a snapshot of the endpoints,
+identities and CIDR names which resolve the recorded events, see
+save_snapshot.
+
+A time window is located through the index, only the segments which
+overlap it have to be decompressed. Segments which were not sealed when
+the recording stopped are not in the index and are ignored.
+"""
+from typing import Dict, List, Tuple
+import json
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+extensions = {"gzip": "json.gz", "zstd": "json.zst"}
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "gzip"
+
+
+class SegmentRecorder:
+    """SegmentRecorder records the output of one node. Events are
+    compressed as they are written, a segment is sealed when
+    `segment_bytes` of events were written to it or it spans more than
+    `segment_seconds`.
+    """
+    def __init__(self, directory: str, node: str,
+                 segment_bytes: int = 16 * 1024 * 1024,
+                 segment_seconds: float = 60.0, codec: str = None):
+        self.node = node
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.codec = codec or default_codec()
+        if self.codec == "zstd" and zstandard is None:
+            raise ValueError("zstandard is not installed")
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory,
+                                 f"{node}.{extensions[self.codec]}")
+        self.file = open(self.path, 'ab')
+        self.file.seek(0, os.SEEK_END)
+        self.index = open(os.path.join(directory, f"{node}.index"), 'a')
+
+        self.compressor = None
+        self.offset = 0
+        self.written = 0
+        self.raw_size = 0
+        self.events = 0
+        self.start = 0.0
+        self.end = 0.0
+
+    def new_compressor(self):
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor().compressobj()
+        # wbits 31 writes a gzip member
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def write(self, data: bytes):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(compressed)
+            self.written += len(compressed)
+
+    def write_frames(self, timestamp: float, buffer: bytearray,
+                     frames: List[Tuple[int, int]]):
+        """write_frames records the events at (start, end) offsets of
+        buffer, received at timestamp
+        """
+        if self.compressor is None:
+            self.compressor = self.new_compressor()
+            self.offset = self.file.tell()
+            self.written = 0
+            self.raw_size = 0
+            self.events = 0
+            self.start = timestamp
+
+        with memoryview(buffer) as view:
+            data = b"\n".join(
+                [b'{"type":"timestamp","timestamp":%r}' % timestamp]
+                + [view[start:end] for start, end in frames]) + b"\n"
+        self.write(data)
+        self.raw_size += len(data)
+        self.events += len(frames)
+        self.end = timestamp
+
+        if (self.raw_size >= self.segment_bytes
+                or self.end - self.start >= self.segment_seconds):
+            self.seal()
+
+    def seal(self):
+        if self.compressor is None:
+            return
+        tail = self.compressor.flush()
+        self.file.write(tail)
+        self.written += len(tail)
+        self.file.flush()
+        self.compressor = None
+
+        self.index.write(json.dumps({
+            'node': self.node,
+            'start': self.start,
+            'end': self.end,
+            'offset': self.offset,
+            'length': self.written,
+            'events': self.events,
+            'codec': self.codec}) + "\n")
+        self.index.flush()
+
+    def close(self):
+        self.seal()
+        self.file.close()
+        self.index.close()
+
+
+def read_index(path: str) -> List[Dict]:
+    """read_index returns the segments listed in an index file"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def segment_path(directory: str, segment: Dict) -> str:
+    return os.path.join(
+        directory, f"{segment['node']}.{extensions[segment['codec']]}")
+
+
+def read_segment(directory: str, segment: Dict) -> bytes:
+    """read_segment returns the decompressed events of a segment"""
+    with open(segment_path(directory, segment), 'rb') as f:
+        f.seek(segment['offset'])
+        data = f.read(segment['length'])
+    if segment['codec'] == "zstd":
+        if zstandard is None:
+            raise ValueError("zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+def segments_in_window(segments: List[Dict], since: float = None,
+                       until: float = None) -> List[Dict]:
+    """segments_in_window returns segments which overlap the window"""
+    return [s for s in segments
+            if (since is None or s['end'] >= since)
+            and (until is None or s['start'] <= until)]
+
+
+snapshot_file = "endpoints.json"
+
+
+def save_snapshot(directory: str, snapshot: Dict):
+    """save_snapshot saves an EndpointResolver snapshot to the recording.
+    It is merged with a snapshot saved earlier, so endpoints deleted
+    while recording can still be resolved.
+    """
+    previous = load_snapshot(directory)
+    endpoints = {ep[0]: ep for ep in previous['endpoints']}
+    endpoints.update((ep[0], ep) for ep in snapshot['endpoints'])
+    identities = dict(previous['identities'])
+    identities.update(snapshot['identities'])
+    cidrs = dict(previous['cidrs'])
+    cidrs.update(snapshot['cidrs'])
+    merged = {'endpoints': list(endpoints.values()),
+              'identities': identities,
+              'cidrs': list(cidrs.items())}
+
+    path = os.path.join(directory, snapshot_file)
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(merged, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_snapshot(directory: str) -> Dict:
+    """load_snapshot returns the snapshot saved to the recording, an empty
+    one if there is none
+    """
+    try:
+        with open(os.path.join(directory, snapshot_file)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'endpoints': [], 'identities': {}, 'cidrs': []}
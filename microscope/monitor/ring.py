@@ -0,0 +1,234 @@
+from typing import Dict, List, Optional
+from collections import deque
+import marshal
+import queue as queuemodule
+import struct
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+from microscope.monitor.event import MonitorEvent
+
+
+class FrameTooLarge(ValueError):
+    """FrameTooLarge is raised for frames which can never fit the ring,
+    waiting for the consumer would not help
+    """
+
+
+def encode_frame(frame: Dict) -> bytes:
+    """encode_frame serializes a batch frame with marshal. MonitorEvents
+    are stored as tuples of their field values, text as str.
+    """
+    outputs = [o.as_tuple() if isinstance(o, MonitorEvent) else o
+               for o in frame['outputs']]
+    return marshal.dumps((frame['name'], frame['node_name'], outputs,
+                          frame.get('dropped', 0)))
+
+
+def decode_frame(data: bytes) -> Dict:
+    name, node_name, outputs, dropped = marshal.loads(data)
+    return {
+        'name': name,
+        'node_name': node_name,
+        'outputs': [MonitorEvent.from_tuple(o) if isinstance(o, tuple) else o
+                    for o in outputs],
+        'dropped': dropped}
+
+
+class RingBuffer:
+    """RingBuffer is a single producer, single consumer queue of batch
+    frames in shared memory, so frames move from a monitor process to the
+    consumer without pickling or pipe syscalls.
+
+    The shared memory starts with a header of three counters: bytes written
+    (only updated by the producer), bytes read (only updated by the
+    consumer) and overflows, the number of times the producer found the
+    ring full. Records are a
+    4 byte length followed by the encoded frame, and wrap around the end
+    of the data area.
+
+    The producer uses the same methods as multiprocessing.Queue, so it can
+    be passed to Monitor as its queue. Processes must be forked, the shared
+    memory is not reattached by name.
+    """
+
+    header = struct.Struct("<QQQ")
+    record_length = struct.Struct("<I")
+
+    def __init__(self, node_name: str, capacity: int = 4 * 1024 * 1024):
+        if shared_memory is None:
+            raise RuntimeError("shared memory transport requires "
+                               "Python 3.8 or newer")
+        self.node_name = node_name
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.header.size + capacity)
+        self.shm.buf[:self.header.size] = bytes(self.header.size)
+        self.data = self.shm.buf[self.header.size:]
+
+    def counters(self):
+        return self.header.unpack_from(self.shm.buf)
+
+    @property
+    def overflows(self) -> int:
+        return self.counters()[2]
+
+    def put(self, frame: Dict, block: bool = True, timeout: float = None):
+        """put writes the frame. If there is not enough free space, it
+        counts an overflow and waits for the consumer or raises
+        queue.Full. Frames larger than the ring raise FrameTooLarge.
+        """
+        payload = encode_frame(frame)
+        if self.record_length.size + len(payload) > self.capacity:
+            raise FrameTooLarge(f"{len(payload)} byte frame does not fit "
+                                f"a {self.capacity} byte ring")
+        if self.write(payload):
+            return
+
+        struct.pack_into("<Q", self.shm.buf, 16, self.overflows + 1)
+        if not block:
+            raise queuemodule.Full
+
+        deadline = None if timeout is None else time.time() + timeout
+        interval = 0.0005
+        while not self.write(payload):
+            if deadline is not None and time.time() >= deadline:
+                raise queuemodule.Full
+            time.sleep(interval)
+            interval = min(interval * 2, 0.02)
+
+    def put_nowait(self, frame: Dict):
+        self.put(frame, False)
+
+    def write(self, payload: bytes) -> bool:
+        written, read, _ = self.counters()
+        size = self.record_length.size + len(payload)
+        if self.capacity - (written - read) < size:
+            return False
+
+        self.copy_in(written, self.record_length.pack(len(payload)))
+        self.copy_in(written + self.record_length.size, payload)
+        # publish the record only after it is fully written
+        struct.pack_into("<Q", self.shm.buf, 0, written + size)
+        return True
+
+    def read(self) -> Optional[bytes]:
+        written, read, _ = self.counters()
+        if written == read:
+            return None
+
+        length, = self.record_length.unpack(
+            self.copy_out(read, self.record_length.size))
+        payload = self.copy_out(read + self.record_length.size, length)
+        struct.pack_into("<Q", self.shm.buf, 8,
+                         read + self.record_length.size + length)
+        return payload
+
+    def get_frame(self) -> Optional[Dict]:
+        payload = self.read()
+        if payload is None:
+            return None
+        return decode_frame(payload)
+
+    def copy_in(self, pos: int, data: bytes):
+        start = pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start:start + first] = data[:first]
+        if first < len(data):
+            self.data[:len(data) - first] = data[first:]
+
+    def copy_out(self, pos: int, length: int) -> bytes:
+        start = pos % self.capacity
+        first = min(length, self.capacity - start)
+        data = bytes(self.data[start:start + first])
+        if first < length:
+            data += bytes(self.data[:length - first])
+        return data
+
+    def close(self):
+        self.data.release()
+        self.shm.close()
+
+    def join_thread(self):
+        # nothing is buffered in the producer process
+        pass
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class RingGroupReader:
+    """RingGroupReader consumes frames from the rings of all monitors.
+
+    It provides the `get`, `put` and `empty` methods of the data queue used
+    by the batch and rich UI consumers. Rings are polled round robin, with
+    the poll interval backing off to `max_poll_interval` seconds while all
+    of them are empty. Frames passed to `put` are delivered before frames
+    from the rings.
+    """
+    def __init__(self, rings: List[RingBuffer],
+                 max_poll_interval: float = 0.02):
+        self.rings = rings
+        self.max_poll_interval = max_poll_interval
+        self.local = deque()
+        self.next_ring = 0
+
+    def poll(self) -> Optional[Dict]:
+        if self.local:
+            return self.local.popleft()
+        for _ in range(len(self.rings)):
+            ring = self.rings[self.next_ring]
+            self.next_ring = (self.next_ring + 1) % len(self.rings)
+            frame = ring.get_frame()
+            if frame is not None:
+                return frame
+        return None
+
+    def get(self, block: bool = True, timeout: float = None) -> Dict:
+        frame = self.poll()
+        if frame is not None or not block:
+            if frame is None:
+                raise queuemodule.Empty
+            return frame
+
+        deadline = None if timeout is None else time.time() + timeout
+        interval = 0.0005
+        while frame is None:
+            if deadline is not None and time.time() >= deadline:
+                raise queuemodule.Empty
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+            frame = self.poll()
+        return frame
+
+    def get_nowait(self) -> Dict:
+        return self.get(False)
+
+    def put(self, frame: Dict):
+        self.local.append(frame)
+
+    def empty(self) -> bool:
+        if self.local:
+            return False
+        for r in self.rings:
+            written, read, _ = r.counters()
+            if written != read:
+                return False
+        return True
+
+    def overflows(self) -> Dict[str, int]:
+        """overflows returns the number of times per node the producer
+        found its ring full
+        """
+        return {r.node_name: r.overflows for r in self.rings}
+
+    def close(self):
+        for r in self.rings:
+            r.close()
+            r.unlink()
+        self.rings = []
@@ -1,7 +1,8 @@
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
 import json
 import sys
-from multiprocessing import Queue
+from multiprocessing import Pipe, Queue
+import queue as queuemodule
 
 from kubernetes import client
 from kubernetes.client.apis import core_v1_api
@@ -9,7 +10,12 @@ from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream
 
 from microscope.monitor.monitor import Monitor
+from microscope.monitor.engine import AsyncMonitorEngine, split_monitors
+from microscope.monitor.ring import RingBuffer, RingGroupReader
 from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.epwatcher import EndpointWatcher
+from microscope.monitor.identities import IdentityCache
+from microscope.monitor.recorder import save_snapshot
 
 
 class MonitorArgs:
@@ -30,7 +36,8 @@ class MonitorArgs:
                  raw: bool,
                  related_ips: List[str],
                  to_ips: List[str],
-                 from_ips: List[str]
+                 from_ips: List[str],
+                 substring_selectors: bool = False
                  ):
         self.verbose = verbose
         self.hex = hex_mode
@@ -49,6 +56,7 @@ class MonitorArgs:
         self.related_ips = related_ips
         self.to_ips = to_ips
         self.from_ips = from_ips
+        self.substring_selectors = substring_selectors
 
     def preprocess_pod_names(self, names: List[str]) -> List[str]:
         def defaultize(name: str):
@@ -58,15 +66,122 @@ class MonitorArgs:
                 return f'{self.namespace}:' + name
         return [defaultize(n) for n in names]
 
+    def endpoint_namespaces(self, selector_namespace: str) -> Set[str]:
+        """endpoint_namespaces returns namespaces of the endpoints the
+        filters reference, or None if they can reference any endpoint
+        """
+        if (self.related_ips or self.to_ips or self.from_ips or
+                self.related_endpoints or self.to_endpoints or
+                self.from_endpoints):
+            return None
+
+        pods = self.related_pods + self.to_pods + self.from_pods
+        namespaces = {pod.split(':', 1)[0] for pod in pods}
+        if (self.related_selectors or self.to_selectors or
+                self.from_selectors):
+            namespaces.add(selector_namespace)
+        return namespaces or None
+
+    def resolve_endpoints(self, resolver: EndpointResolver,
+                          namespace: str) -> Tuple[Set[int], Set[int],
+                                                   Set[int]]:
+        """resolve_endpoints returns ids of the related, to and from
+        endpoints the filters select. Selectors match endpoints in
+        namespace.
+        """
+        related_ids = resolver.resolve_endpoint_ids(
+            self.related_selectors,
+            self.related_pods,
+            self.related_ips,
+            namespace,
+            self.substring_selectors)
+        if (self.related_selectors or self.related_pods) and not related_ids:
+            raise NoEndpointException("No related endpoints found")
+
+        related_ids.update(self.related_endpoints)
+
+        to_ids = resolver.resolve_endpoint_ids(
+            self.to_selectors,
+            self.to_pods,
+            self.to_ips,
+            namespace,
+            self.substring_selectors)
+        if (self.to_selectors or self.to_pods) and not to_ids:
+            raise NoEndpointException("No to endpoints found")
+
+        to_ids.update(self.to_endpoints)
+
+        from_ids = resolver.resolve_endpoint_ids(
+            self.from_selectors,
+            self.from_pods,
+            self.from_ips,
+            namespace,
+            self.substring_selectors)
+        if (self.from_selectors or self.from_pods) and not from_ids:
+            raise NoEndpointException("No from endpoints found")
+
+        from_ids.update(self.from_endpoints)
+
+        return related_ids, to_ids, from_ids
+
 
 class MonitorRunner:
-    def __init__(self, namespace, api, endpoint_namespace):
+    """MonitorRunner starts monitors on Cilium nodes
+
+    engine: "process" runs every monitor in its own process, "asyncio"
+            follows all monitors from `engine_workers` processes, each
+            running an asyncio event loop for its share of nodes
+    transport: "queue" sends monitor output through a multiprocessing
+               queue of at most `queue_size` batch frames (0 is unbounded),
+               "shm" through a shared memory ring of `ring_size` bytes per
+               monitor. With "shm", `data_queue` is a RingGroupReader.
+    drop_policy: what monitors do when the consumer falls behind, see
+                 BatchSender. `node_drop_policies` overrides it per node,
+                 keyed by node or Cilium pod name.
+    watch_endpoints: keep the resolver up to date with endpoints created
+                     and deleted while running
+    cidr_names: (CIDR, name) pairs to show for addresses which are not
+                endpoints, in addition to node and service IPs
+    scope_endpoints: list and watch endpoints of a single namespace when
+                     the filters only reference that namespace. Events
+                     from other namespaces are then shown with identity
+                     labels instead of pod names.
+    record_dir: directory to record the raw JSON output of every node
+                to, see SegmentRecorder. Nothing is recorded in verbose
+                and raw modes. A snapshot of the resolver is saved there
+                at start and on finish, for replay.
+    """
+    def __init__(self, namespace, api, endpoint_namespace,
+                 engine: str = "process", engine_workers: int = 1,
+                 transport: str = "queue", ring_size: int = 4 * 1024 * 1024,
+                 queue_size: int = 1024, drop_policy: str = "block",
+                 node_drop_policies: Dict[str, str] = None,
+                 watch_endpoints: bool = True,
+                 scope_endpoints: bool = True,
+                 cidr_names: List[Tuple[str, str]] = None,
+                 record_dir: str = None):
         self.namespace = namespace
         self.api = api
         self.endpoint_namespace = endpoint_namespace
+        self.engine = engine
+        self.engine_workers = engine_workers
+        self.transport = transport
+        self.ring_size = ring_size
+        self.drop_policy = drop_policy
+        self.node_drop_policies = node_drop_policies or {}
+        self.watch_endpoints = watch_endpoints
+        self.scope_endpoints = scope_endpoints
+        self.cidr_names = cidr_names or []
+        self.record_dir = record_dir
+        self.endpoint_watcher = None
+        self.identity_cache = None
         self.monitors = []
-        self.data_queue = Queue()
+        self.workers = []
+        self.resolver = None
+        self.data_queue = Queue(queue_size)
         self.close_queue = Queue()
+        # monitors wait on the read end, it becomes readable on finish
+        self.shutdown_reader, self.shutdown_writer = Pipe(duplex=False)
 
     def run(self, monitor_args: MonitorArgs, nodes: List[str],
             cmd_override: str):
@@ -77,7 +192,7 @@ class MonitorRunner:
             pods = api.list_namespaced_pod(self.namespace,
                                            label_selector='k8s-app=cilium')
         except ApiException as e:
-            print('could not list Cilium pods: %s\n' % e)
+            print('could not list Cilium pods: %s\n' % e, file=sys.stderr)
             sys.exit(1)
 
         if nodes:
@@ -95,13 +210,39 @@ class MonitorRunner:
             raise ValueError('No Cilium nodes in cluster match provided names'
                              ', or Cilium is not deployed')
 
-        endpoints = self.retrieve_endpoint_data()
-        pod_resolver = EndpointResolver(endpoints)
+        self.resolver = EndpointResolver([])
+        self.endpoint_watcher = EndpointWatcher(
+            self.resolver,
+            namespace=self.get_endpoint_scope(monitor_args, cmd_override))
+        self.endpoint_watcher.relist()
+        self.add_cidr_names(api)
+
+        crds = client.CustomObjectsApi()
+
+        def get_identity(name: str) -> Dict:
+            try:
+                return crds.get_cluster_custom_object(
+                    "cilium.io", "v2", "ciliumidentities", name)
+            except ApiException as e:
+                if e.status == 404:
+                    return None
+                raise
+
+        self.identity_cache = IdentityCache(
+            lambda: crds.list_cluster_custom_object("cilium.io", "v2",
+                                                    "ciliumidentities"),
+            get_identity, on_update=self.resolver.changed)
+        self.resolver.identity_source = self.identity_cache
+        # saved before the watch thread starts changing the resolver
+        self.record_snapshot()
+        self.identity_cache.start()
+        if self.watch_endpoints:
+            self.endpoint_watcher.start()
 
         if cmd_override:
             cmd = cmd_override.split(" ")
         else:
-            cmd = self.get_monitor_command(monitor_args, names, pod_resolver)
+            cmd = self.get_monitor_command(monitor_args, names, self.resolver)
 
         mode = ""
 
@@ -111,13 +252,98 @@ class MonitorRunner:
         if monitor_args.verbose or cmd_override:
             mode = "verbose"
 
+        if self.transport == "shm":
+            queues = [RingBuffer(name[1], self.ring_size) for name in names]
+            self.data_queue = RingGroupReader(queues)
+        else:
+            queues = [self.data_queue for name in names]
+
         self.monitors = [
-            Monitor(name[0], name[1], self.namespace, self.data_queue,
-                    self.close_queue, api, cmd, mode, pod_resolver)
-            for name in names]
+            Monitor(name[0], name[1], self.namespace, queue,
+                    self.close_queue, self.shutdown_reader, api, cmd, mode,
+                    self.get_drop_policy(name),
+                    reconnect=not cmd_override,
+                    record_dir=self.record_dir)
+            for name, queue in zip(names, queues)]
+
+        if self.engine == "asyncio":
+            self.workers = [
+                AsyncMonitorEngine(shard, self.close_queue,
+                                   self.shutdown_reader).process
+                for shard in split_monitors(self.monitors,
+                                            self.engine_workers)]
+        else:
+            self.workers = [m.process for m in self.monitors]
 
-        for m in self.monitors:
-            m.process.start()
+        for w in self.workers:
+            w.start()
+
+    def add_cidr_names(self, api: core_v1_api.CoreV1Api):
+        """add_cidr_names lets the resolver name node and service IPs and
+        the user provided CIDRs, which take precedence
+        """
+        try:
+            for node in api.list_node().items:
+                for address in node.status.addresses or []:
+                    if address.type in ('InternalIP', 'ExternalIP'):
+                        self.resolver.add_cidr(address.address,
+                                               f'node/{node.metadata.name}')
+        except ApiException as e:
+            print(f'could not list nodes, node IPs are not resolved: {e}',
+                  file=sys.stderr)
+
+        try:
+            services = api.list_service_for_all_namespaces().items
+        except ApiException as e:
+            print(f'could not list services, service IPs are not resolved: '
+                  f'{e}', file=sys.stderr)
+            services = []
+        for svc in services:
+            if svc.spec.cluster_ip and svc.spec.cluster_ip != 'None':
+                self.resolver.add_cidr(
+                    svc.spec.cluster_ip,
+                    f'svc/{svc.metadata.namespace}:{svc.metadata.name}')
+
+        for cidr, name in self.cidr_names:
+            self.resolver.add_cidr(cidr, name)
+
+    def record_snapshot(self):
+        """record_snapshot saves endpoints and all identities known to the
+        cluster to the recording
+        """
+        if (not self.record_dir or self.resolver is None
+                or self.identity_cache is None):
+            return
+        snapshot = self.resolver.snapshot()
+        try:
+            snapshot['identities'].update(
+                (str(identity), labels) for identity, labels
+                in self.identity_cache.fetch_all().items())
+        except ApiException as e:
+            print(f'could not list identities, only identities of '
+                  f'endpoints are saved: {e}', file=sys.stderr)
+        try:
+            save_snapshot(self.record_dir, snapshot)
+        except OSError as e:
+            print(f'could not save endpoint snapshot: {e}',
+                  file=sys.stderr)
+
+    def get_endpoint_scope(self, args: MonitorArgs, cmd_override: str):
+        """get_endpoint_scope returns the namespace to list endpoints in,
+        None for all namespaces
+        """
+        if not self.scope_endpoints or cmd_override:
+            return None
+        namespaces = args.endpoint_namespaces(self.endpoint_namespace)
+        if namespaces is not None and len(namespaces) == 1:
+            return namespaces.pop()
+        return None
+
+    def get_drop_policy(self, name) -> str:
+        pod_name, node_name = name
+        return self.node_drop_policies.get(
+            node_name,
+            self.node_drop_policies.get(pod_name, self.drop_policy))
 
     def retrieve_endpoint_info(self, endpoint_data: Dict) -> Dict:
         return {x["status"]["id"]:
@@ -130,35 +356,8 @@ class MonitorRunner:
 
     def get_monitor_command(self, args: MonitorArgs, names: List[str],
                             resolver: EndpointResolver) -> List[str]:
-        related_ids = resolver.resolve_endpoint_ids(
-            args.related_selectors,
-            args.related_pods,
-            args.related_ips,
-            self.endpoint_namespace)
-        if (args.related_selectors or args.related_pods) and not related_ids:
-            raise NoEndpointException("No related endpoints found")
-
-        related_ids.update(args.related_endpoints)
-
-        to_ids = resolver.resolve_endpoint_ids(
-            args.to_selectors,
-            args.to_pods,
-            args.to_ips,
-            self.endpoint_namespace)
-        if (args.to_selectors or args.to_pods) and not to_ids:
-            raise NoEndpointException("No to endpoints found")
-
-        to_ids.update(args.to_endpoints)
-
-        from_ids = resolver.resolve_endpoint_ids(
-            args.from_selectors,
-            args.from_pods,
-            args.from_ips,
-            self.endpoint_namespace)
-        if (args.from_selectors or args.from_pods) and not from_ids:
-            raise NoEndpointException("No from endpoints found")
-
-        from_ids.update(args.from_endpoints)
+        related_ids, to_ids, from_ids = args.resolve_endpoints(
+            resolver, self.endpoint_namespace)
 
         exec_command = [
             'cilium',
@@ -195,15 +394,9 @@ class MonitorRunner:
                 exec_command.append('--type')
                 exec_command.append(t)
 
-        print(exec_command)
+        print(exec_command, file=sys.stderr)
         return exec_command
 
-    def retrieve_endpoint_data(self):
-        crds = client.CustomObjectsApi()
-        cep_resp = crds.list_cluster_custom_object("cilium.io", "v2",
-                                                   "ciliumendpoints")
-        return [e['status'] for e in cep_resp['items'] if 'status' in e]
-
     def get_node_endpoint_data(self, node: str):
         exec_command = ['cilium', 'endpoint', 'list', '-o', 'json']
         resp = stream(self.api.connect_get_namespaced_pod_exec, node,
@@ -229,13 +422,40 @@ class MonitorRunner:
         self.data_queue.put(data)
 
     def finish(self):
-        print('\nclosing')
+        print('\nclosing', file=sys.stderr)
+        if self.endpoint_watcher is not None:
+            self.endpoint_watcher.stop()
+        if self.identity_cache is not None:
+            self.identity_cache.stop()
         self.close_queue.put('close')
-        for m in self.monitors:
-            m.process.join()
+        self.shutdown_writer.send_bytes(b'close')
+        for w in self.workers:
+            # consumers are done, discard output which would otherwise
+            # keep monitors waiting for space in the data queue
+            while w.is_alive():
+                self.discard_output()
+                w.join(0.1)
+        if self.transport == "shm":
+            self.data_queue.close()
+        self.record_snapshot()
+
+    def discard_output(self):
+        try:
+            while True:
+                self.data_queue.get_nowait()
+        except queuemodule.Empty:
+            pass
+
+    def overflows(self) -> Dict[str, int]:
+        """overflows returns the number of times per node a monitor found
+        its shared memory ring full
+        """
+        if self.transport == "shm":
+            return self.data_queue.overflows()
+        return {}
 
     def is_alive(self):
-        return any([m.process.is_alive() for m in self.monitors])
+        return any([w.is_alive() for w in self.workers])
 
 
 class NoEndpointException(Exception):
@@ -1,8 +1,32 @@
+import asyncio
+import json
+import multiprocessing
+import pickle
+import queue as queuemodule
+import socket
+import threading
 import time
+import types
+
+import pytest
+
 from microscope.monitor.parser import MonitorOutputProcessorSimple
 from microscope.monitor.parser import MonitorOutputProcessorVerbose
 from microscope.monitor.parser import MonitorOutputProcessorJSON
-from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.epresolver import EndpointResolver, compact_endpoint
+from microscope.monitor.epresolver import ip_key
+from microscope.monitor.formatter import EventFormatter, JSONEventFormatter
+from microscope.monitor import jsoncodec
+from microscope.monitor.transport import BatchSender
+from microscope.monitor.ring import RingBuffer, RingGroupReader
+from microscope.monitor.ring import FrameTooLarge
+from microscope.monitor.event import MonitorEvent
+from microscope.monitor.cidr import PrefixTrie, load_cidr_names
+from microscope.monitor.cache import LRUCache
+from microscope.monitor.identities import IdentityCache
+from microscope.monitor.recorder import SegmentRecorder, read_index
+from microscope.monitor.recorder import read_segment, segments_in_window
+from microscope.monitor.recorder import save_snapshot, load_snapshot
 
 
 def test_non_verbose_mode():
@@ -16,13 +40,19 @@ def test_non_verbose_mode():
     p.add_out(output)
 
     msgs = [x for x in p]
+    assert len(msgs) == 3
+    assert p.wait_timeout() == p.idle_timeout
+
+    p.on_idle()
+    msgs += [x for x in p]
     assert len(msgs) == 4
+    assert p.wait_timeout() is None
 
     retrieved = "\n".join(msgs)
 
     assert output == retrieved
 
-    p.add_out(output)
+    p.add_out(output + "\n")
 
     msgs = [x for x in p]
     assert len(msgs) == 4
@@ -31,8 +61,8 @@ def test_non_verbose_mode():
 
     assert output == retrieved
 
-    p.add_out(output)
-    p.add_out(output)
+    p.add_out(output + "\n")
+    p.add_out(output + "\n")
 
     msgs = [x for x in p]
     assert len(msgs) == 8
@@ -42,6 +72,21 @@ def test_non_verbose_mode():
     assert output + '\n' + output == retrieved
 
 
+def test_lines_split_across_chunks():
+    p = MonitorOutputProcessorSimple()
+
+    p.add_out("first li")
+    p.add_out("ne\nsecond ")
+    assert list(p) == ["first line"]
+
+    p.add_out("line\n\nthird")
+    p.add_err("error")
+    assert list(p) == ["error", "second line", ""]
+
+    p.on_idle()
+    assert list(p) == ["third"]
+
+
 def test_verbose_mode():
     p = MonitorOutputProcessorVerbose()
 
@@ -63,16 +108,35 @@ def test_verbose_mode():
 
     assert msgs[1] == "---\n" + output.split("---")[1].strip("\n")
 
-    time.sleep(p.last_event_wait_timeout / 1000)
+    timeout = p.wait_timeout()
+    assert p.min_idle <= timeout <= p.max_idle
+
+    p.on_idle()
 
     msgs = [x for x in p]
     assert len(msgs) == 1
 
     assert msgs[0] == "---\n" + output.split("---")[2].strip("\n")
+    assert p.wait_timeout() is None
+
+
+def test_verbose_idle_timeout_adapts():
+    p = MonitorOutputProcessorVerbose()
+    p.add_out("---\nCPU 01: MARK 0x0 FROM 1234 to-endpoint\n")
+    p.last_read -= 0.3
+    p.on_idle()
+    assert list(p) == ["---\nCPU 01: MARK 0x0 FROM 1234 to-endpoint"]
+
+    # the rest of the message arrived after it was ended
+    p.add_out("Ethernet\t{Contents=[..14..]}\n")
+    assert p.wait_timeout() == p.max_idle
+
+    p.add_out("---\nCPU 01: MARK 0x0 FROM 1234 to-endpoint\n")
+    assert list(p) == ["Ethernet\t{Contents=[..14..]}"]
 
 
 def test_json_processor_get_event():
-    p = MonitorOutputProcessorJSON(None)
+    p = MonitorOutputProcessorJSON()
 
     p.add_out('{"trolo1":"lolo1"}\n')
     p.add_out('{"trolo2":"')
@@ -84,6 +148,182 @@ def test_json_processor_get_event():
     assert p.get_event() == '{"trolo2":"lolo2"}'
 
 
+def test_json_processor_get_event_strings():
+    p = MonitorOutputProcessorJSON()
+
+    p.add_out('Listening for events on 2 CPUs\n')
+    p.add_out('{"path":"/a}{b","msg":"say \\"}\\""')
+    p.add_out(', "n":{"x":"{"}}{"esc":"\\')
+    assert p.get_event() == (
+        '{"path":"/a}{b","msg":"say \\"}\\"", "n":{"x":"{"}}')
+    assert p.get_event() is None
+
+    p.add_out('"}"}')
+    assert p.get_event() == '{"esc":"\\"}"}'
+    assert p.get_event() is None
+
+
+def test_json_processor_get_events():
+    backends = ["stdlib"]
+    if jsoncodec.orjson is not None:
+        backends.append("orjson")
+
+    for backend in backends:
+        jsoncodec.use_backend(backend)
+        p = MonitorOutputProcessorJSON()
+
+        p.add_out('{"a":"zażółć\tx"}\n{broken}{"b":')
+        p.add_out('[1, {"c": "}"}]} {"d"')
+
+        assert p.get_events() == [
+            {"a": "zażółć\tx"}, "{broken}", {"b": [1, {"c": "}"}]}]
+        assert p.get_events() == []
+
+        p.add_out(': null}')
+        assert p.get_events() == [{"d": None}]
+
+    jsoncodec.use_backend(backends[-1])
+
+
+def test_batch_sender():
+    q = queuemodule.Queue()
+    sender = BatchSender(q, "cilium-abcde", "node1", max_events=3)
+
+    sender.flush()
+    assert q.empty()
+
+    for i in range(4):
+        sender.add(str(i))
+    sender.flush()
+
+    assert q.get_nowait() == {'name': 'cilium-abcde', 'node_name': 'node1',
+                              'outputs': ['0', '1', '2'], 'dropped': 0}
+    assert q.get_nowait()['outputs'] == ['3']
+    assert q.empty()
+
+
+def test_batch_sender_drop_policies():
+    def fill(policy):
+        q = queuemodule.Queue(2)
+        sender = BatchSender(q, "cilium-abcde", "node1", max_events=2,
+                             policy=policy, backlog=1, sample_rate=2)
+        for i in range(12):
+            sender.add(i)
+        return q, sender
+
+    q, sender = fill('drop-newest')
+    assert [q.get_nowait()['outputs'] for _ in range(2)] == [[0, 1], [2, 3]]
+    assert sender.dropped == 8
+    sender.close()
+    assert q.get_nowait() == {'name': 'cilium-abcde', 'node_name': 'node1',
+                              'outputs': [], 'dropped': 8}
+
+    q, sender = fill('drop-oldest')
+    assert [q.get_nowait()['outputs'] for _ in range(2)] == [[0, 1], [2, 3]]
+    assert sender.dropped == 6
+    sender.close()
+    assert q.get_nowait() == {'name': 'cilium-abcde', 'node_name': 'node1',
+                              'outputs': [10, 11], 'dropped': 6}
+
+    q, sender = fill('sample')
+    assert [q.get_nowait()['outputs'] for _ in range(2)] == [[0, 1], [2, 3]]
+    # every other message is kept until a frame fits in the queue again
+    sender.add(12)
+    sender.add(13)
+    assert q.get_nowait() == {'name': 'cilium-abcde', 'node_name': 'node1',
+                              'outputs': [11, 13], 'dropped': 8}
+    sender.add(14)
+    sender.add(15)
+    assert q.get_nowait()['outputs'] == [14, 15]
+
+
+def test_batch_sender_retries_backlog():
+    q = queuemodule.Queue(1)
+    sender = BatchSender(q, "cilium-abcde", "node1", max_events=1,
+                         policy='drop-oldest', retry_interval=0.1)
+    assert sender.wait_timeout(None) is None
+    sender.add(0)
+    sender.add(1)
+    assert sender.wait_timeout(None) == 0.1
+    assert sender.wait_timeout(0.02) == 0.02
+
+    # the read loop times out on a quiet stream and flushes
+    assert q.get_nowait()['outputs'] == [0]
+    sender.flush()
+    assert q.get_nowait()['outputs'] == [1]
+    assert sender.wait_timeout(None) is None
+
+
+def test_ring_buffer():
+    ring = RingBuffer("node1", capacity=64)
+    other = RingBuffer("node2", capacity=4096)
+    reader = RingGroupReader([ring, other])
+    try:
+        assert ring.read() is None
+        assert reader.empty()
+
+        # wraps around the end of the data area a few times
+        for i in range(10):
+            payload = bytes([i]) * 20
+            assert ring.write(payload)
+            assert ring.read() == payload
+
+        assert ring.write(b"a" * 30)
+        assert not ring.write(b"b" * 30)
+        try:
+            ring.put_nowait({'name': 'cilium-0', 'node_name': 'node1',
+                             'outputs': []})
+            assert False
+        except queuemodule.Full:
+            pass
+        assert ring.overflows == 1
+        assert reader.overflows() == {"node1": 1, "node2": 0}
+        assert ring.read() == b"a" * 30
+
+        event = MonitorEvent("trace", "node2", src_ip="10.0.0.1",
+                             src_labels=["k8s:id=app1"])
+        other.put({'name': 'cilium-1', 'node_name': 'node2',
+                   'outputs': [event, "text"]})
+        assert not reader.empty()
+        assert reader.get(True, 1) == {
+            'name': 'cilium-1', 'node_name': 'node2',
+            'outputs': [event, "text"], 'dropped': 0}
+
+        reader.put({})
+        assert reader.get_nowait() == {}
+        try:
+            reader.get(True, 0.01)
+            assert False
+        except queuemodule.Empty:
+            pass
+    finally:
+        reader.close()
+
+
+def test_ring_buffer_frame_too_large():
+    ring = RingBuffer("node1", capacity=256)
+    reader = RingGroupReader([ring])
+    try:
+        with pytest.raises(FrameTooLarge):
+            ring.put({'name': 'cilium-0', 'node_name': 'node1',
+                      'outputs': ["x" * 300]})
+        assert ring.overflows == 0
+
+        # frames are split until they fit, messages which never fit are
+        # dropped instead of blocking the monitor
+        sender = BatchSender(ring, "cilium-0", "node1", max_events=8)
+        for msg in ["a" * 60, "b" * 60, "c" * 300, "d" * 60]:
+            sender.add(msg)
+        sender.flush()
+        outputs = []
+        while not reader.empty():
+            outputs += reader.get_nowait()['outputs']
+        assert outputs == ["a" * 60, "b" * 60, "d" * 60]
+        assert sender.dropped == 1
+    finally:
+        reader.close()
+
+
 test_endpoints = [
     {
         'id': 5766,
@@ -192,7 +432,8 @@ test_endpoints = [
 
 def test_json_processor():
     resolver = EndpointResolver(test_endpoints)
-    p = MonitorOutputProcessorJSON(resolver)
+    formatter = EventFormatter(resolver)
+    p = MonitorOutputProcessorJSON("minikube")
 
     p.add_out('{"type":"logRecord","observationPoint":"Ingress","flowType":')
     p.add_out('"Request","l7Proto":"http","srcEpID":0,"srcEpLabels":["k8s:i')
@@ -292,7 +533,16 @@ def test_json_processor():
 }
     """)
 
-    events = [x for x in p]
+    parsed = [x for x in p]
+    assert all(e.node == "minikube" for e in parsed)
+    assert parsed[2].type == "trace"
+    assert parsed[2].src_ip == "10.0.0.1"
+    assert parsed[2].dst_port == "37934"
+    assert parsed[2].src_ep == 5766
+    assert parsed[3].reason == "Policy denied (L3)"
+    assert pickle.loads(pickle.dumps(parsed[3])) == parsed[3]
+
+    events = [formatter.format(x) for x in parsed]
 
     assert len(events) == 7
     assert events[0] == (
@@ -326,6 +576,189 @@ def test_json_processor():
     )
 
 
+def test_format_gap():
+    formatter = EventFormatter(None)
+    gap = MonitorEvent("gap", "node1", 0.0, summary=12.34,
+                       message="cilium-x2bfk")
+
+    assert formatter.format(gap) == (
+        "-- monitor stream lost for 12.3s, reconnected to cilium-x2bfk --")
+
+    record = JSONEventFormatter(None).to_record(gap)
+    assert record == {'node': "node1", 'timestamp': 0.0, 'type': "gap",
+                      'gap_seconds': 12.34, 'pod': "cilium-x2bfk"}
+
+
+def test_backoff():
+    monitor = pytest.importorskip("microscope.monitor.monitor")
+    backoff = monitor.Backoff(base=1.0, cap=8.0, stable_after=30.0)
+    for limit in [1, 2, 4, 8, 8, 8]:
+        assert limit / 2 <= backoff.next_delay() <= limit
+
+    # short connections keep backing off, a stable one resets the delay
+    backoff.connection_lasted(29.0)
+    assert 4 <= backoff.next_delay() <= 8
+    backoff.connection_lasted(30.0)
+    assert 0.5 <= backoff.next_delay() <= 1
+    assert 1 <= backoff.next_delay() <= 2
+
+
+class FakeStream:
+    """FakeStream stands in for the exec websocket client. Data sent to
+    `peer` is the monitor output, closing `peer` ends the stream.
+    """
+    def __init__(self):
+        self.peer, sock = socket.socketpair()
+        self.sock = types.SimpleNamespace(sock=sock)
+        self.fd = sock.fileno()
+        self.stdout = ""
+        self.stdin = ""
+        self.reads = 0
+        self.open = True
+
+    def is_open(self):
+        return self.open
+
+    def update(self, timeout=0):
+        data = self.sock.sock.recv(65536)
+        self.reads += 1
+        if not data:
+            self.open = False
+        self.stdout += data.decode()
+
+    def peek_stdout(self):
+        return bool(self.stdout)
+
+    def read_stdout(self):
+        out, self.stdout = self.stdout, ""
+        return out
+
+    def peek_stderr(self):
+        return False
+
+    def read_stderr(self):
+        return ""
+
+    def write_stdin(self, data):
+        self.stdin += data
+
+    def close(self):
+        self.open = False
+        self.sock.sock.close()
+        self.peer.close()
+
+
+def fake_monitor(name, stream, queue=None, shutdown=None):
+    monitor = pytest.importorskip("microscope.monitor.monitor")
+    m = monitor.Monitor(name, name, "kube-system",
+                        queue or queuemodule.Queue(), None, shutdown, None,
+                        [], "raw")
+
+    def open_stream(api=None):
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+    m.open_stream = open_stream
+    return m
+
+
+def frame_outputs(queue):
+    outputs = []
+    while not queue.empty():
+        outputs += queue.get_nowait()['outputs']
+    return outputs
+
+
+def test_async_engine():
+    engine = pytest.importorskip("microscope.monitor.engine")
+    streams = [FakeStream(), FakeStream()]
+    monitors = [fake_monitor(f"cilium-{i}", stream)
+                for i, stream in enumerate(streams)]
+    broken = fake_monitor("cilium-broken", RuntimeError("forbidden"))
+    for i, stream in enumerate(streams):
+        stream.peer.sendall(f"line{i}\npartial".encode())
+        stream.peer.close()
+
+    assert engine.split_monitors(monitors + [broken], 2) == [
+        [monitors[0], broken], [monitors[1]]]
+    assert engine.split_monitors(monitors, 3) == [[monitors[0]],
+                                                  [monitors[1]]]
+
+    shutdown, _ = multiprocessing.Pipe(False)
+    e = engine.AsyncMonitorEngine(monitors + [broken], None, shutdown)
+    e.thread_api = lambda: None
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(e.serve(), 5))
+        # every reader was removed
+        assert not loop.remove_reader(shutdown.fileno())
+        for stream in streams:
+            assert not loop.remove_reader(stream.fd)
+    finally:
+        loop.close()
+
+    for i, m in enumerate(monitors):
+        assert frame_outputs(m.queue) == [f"line{i}", "partial"]
+        assert not streams[i].open
+    # a stream which could not be opened ends its monitor only
+    assert broken.queue.empty()
+
+
+def test_async_engine_blocked_monitor():
+    engine = pytest.importorskip("microscope.monitor.engine")
+    full = queuemodule.Queue(1)
+    full.put({})
+    streams = [FakeStream(), FakeStream()]
+    blocked = fake_monitor("cilium-0", streams[0], full)
+    free = fake_monitor("cilium-1", streams[1])
+    shutdown, _ = multiprocessing.Pipe(False)
+    e = engine.AsyncMonitorEngine([blocked, free], None, shutdown)
+    e.thread_api = lambda: None
+    loop = asyncio.new_event_loop()
+
+    async def scenario():
+        serving = asyncio.ensure_future(e.serve())
+        streams[0].peer.sendall(b"a\n")
+        await asyncio.sleep(0.2)
+        streams[0].peer.sendall(b"b\n")
+        streams[1].peer.sendall(b"c\n")
+        streams[1].peer.close()
+
+        # the other monitor keeps running
+        frame = await loop.run_in_executor(None, free.queue.get, True, 5)
+        assert frame['outputs'] == ["c"]
+        # the blocked monitor doesn't read its stream
+        assert streams[0].reads == 1
+
+        get = loop.run_in_executor
+        assert await get(None, full.get, True, 5) == {}
+        assert (await get(None, full.get, True, 5))['outputs'] == ["a"]
+        assert (await get(None, full.get, True, 5))['outputs'] == ["b"]
+        streams[0].peer.close()
+        await asyncio.wait_for(serving, 5)
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+
+def test_monitor_follow_shutdown():
+    shutdown, shutdown_writer = multiprocessing.Pipe(False)
+    stream = FakeStream()
+    m = fake_monitor("cilium-0", stream, shutdown=shutdown)
+    stream.peer.sendall(b"line\n")
+
+    # the stream stays quiet, the shutdown pipe alone ends follow
+    threading.Timer(0.2, shutdown_writer.send, [None]).start()
+    start = time.monotonic()
+    assert m.follow(stream, m.create_sender())
+    assert time.monotonic() - start < 1
+    assert stream.stdin == "\x03"
+    assert not stream.open
+    assert frame_outputs(m.queue) == ["line"]
+
+
 def test_resolver_retrieve_ep_ids():
     resolver = EndpointResolver(test_endpoints)
 
@@ -346,6 +779,27 @@ def test_resolver_endpoint_ids_by_selectors():
     assert len(app1_ids) == 2
 
 
+def test_resolver_selector_matching():
+    resolver = EndpointResolver(test_endpoints)
+
+    assert resolver.resolve_endpoint_ids(
+        ['k8s:id=app1'], [], [], 'default') == {30391, 33243}
+    assert resolver.resolve_endpoint_ids(['id=app'], [], [], 'default') == (
+        set())
+    assert resolver.resolve_endpoint_ids(
+        ['id=app'], [], [], 'default', substring=True) == (
+        {5766, 30391, 33243, 51796})
+    assert resolver.resolve_endpoint_ids(
+        ['id=app1'], [], [], 'kube-system') == set()
+
+    resolver.remove_endpoint(30391)
+    resolver.remove_endpoint(33243)
+    assert 'k8s:id=app1' not in resolver.label_index
+    assert 'id=app1' not in resolver.label_keys
+    assert resolver.resolve_endpoint_ids(
+        ['id=app1'], [], [], 'default') == set()
+
+
 def test_resolver_endpoint_ids_by_names():
     resolver = EndpointResolver(test_endpoints)
     ids = resolver.resolve_endpoint_ids(
@@ -357,3 +811,427 @@ def test_resolver_endpoint_ids_by_names():
     assert 30391 in ids
     assert 51796 in ids
     assert len(ids) == 2
+
+
+def test_resolver_compact_keys():
+    resolver = EndpointResolver(test_endpoints)
+
+    assert ip_key("10.0.0.1") == ip_key("::ffff:10.0.0.1")
+    assert ip_key("10.0.0.1") != ip_key("::a00:1")
+    assert ip_key("f00d::a0f:0:0:1686") == ip_key("F00D:0::A0F:0:0:1686")
+    assert ip_key("nonsense") is None
+    assert ip_key(None) is None
+
+    assert resolver.resolve_ip("F00D::A0F:0:0:1686") == "default:app2"
+    assert resolver.resolve_id_from_ip("10.0.0.1") == 5766
+    assert resolver.resolve_id_from_ip("10.9.9.9") == ""
+    assert resolver.resolve_eid(None) == ""
+
+    app1 = [resolver.endpoints[ep_id][1] for ep_id in (30391, 33243)]
+    assert app1[0] is app1[1]
+
+    # keys of event addresses are cached, the cache is emptied when full
+    resolver.ip_key_cache_size = 2
+    resolver.ip_keys.clear()
+    for _ in range(2):
+        assert [resolver.resolve_ip(ip) for ip in (
+            "10.0.0.1", "10.9.9.9", "F00D::A0F:0:0:1686", None)] == [
+            "default:app2", "", "default:app2", ""]
+        assert len(resolver.ip_keys) <= 2
+
+
+def test_resolver_updates():
+    resolver = EndpointResolver(test_endpoints[:2])
+    assert resolver.resolve_ip("10.0.0.1") == "default:app2"
+    assert resolver.resolve_ip("10.0.0.5") == ""
+
+    resolver.add_endpoint(test_endpoints[4])
+    assert resolver.resolve_ip("10.0.0.5") == "default:app3"
+    assert resolver.resolve_eid("51796") == "default:app3"
+    assert resolver.resolve_eid(51796) == "default:app3"
+    assert resolver.resolve_identity(36720) == [
+        'k8s:id=app3', 'k8s:io.kubernetes.pod.namespace=default']
+
+    resolver.remove_endpoint(5766)
+    assert resolver.resolve_ip("10.0.0.1") == ""
+    assert resolver.resolve_ip("f00d::a0f:0:0:1686") == ""
+    assert resolver.resolve_eid("5766") == ""
+    assert resolver.resolve_endpoint_ids([], ['default:app2'], [],
+                                         'default') == set()
+
+    resolver.replace_endpoints(test_endpoints[1:3])
+    assert resolver.resolve_ip("10.0.0.5") == ""
+    assert resolver.resolve_ip("10.0.0.3") == (
+        "kube-system:cilium-health-minikube")
+    assert resolver.resolve_ip("10.0.0.2") == (
+        "default:app1-799c454b56-xcw8t")
+
+
+def cep(ep, version, name=None):
+    return {'metadata': {'namespace': 'default',
+                         'name': name or str(ep['id']),
+                         'resourceVersion': version},
+            'status': ep}
+
+
+class FakeWatchResponse:
+    def __init__(self, events):
+        self.events = events
+
+    def read_chunked(self, decode_content=False):
+        return (json.dumps(e) + "\n" for e in self.events)
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeCRDs:
+    """FakeCRDs answers like CustomObjectsApi of kubernetes 7.0.0, which
+    rejects arguments it does not know
+    """
+    params = {'pretty', 'label_selector', 'resource_version', 'watch',
+              'async_req', '_return_http_data_only', '_preload_content',
+              '_request_timeout'}
+
+    def __init__(self, pages=(), watches=()):
+        self.pages = list(pages)
+        self.watches = list(watches)
+        self.page_queries = []
+        self.watch_calls = []
+        self.api_client = self
+        self.on_last_watch = None
+
+    def list_cluster_custom_object(self, group, version, plural, **kwargs):
+        unexpected = set(kwargs) - self.params
+        if unexpected:
+            raise TypeError(f"Got an unexpected keyword argument "
+                            f"'{unexpected.pop()}'")
+        self.watch_calls.append(kwargs)
+        if not self.watches:
+            self.on_last_watch()
+            return FakeWatchResponse([])
+        return FakeWatchResponse(self.watches.pop(0))
+
+    def call_api(self, path, method, path_params, query_params,
+                 header_params, **kwargs):
+        self.page_queries.append((path, dict(query_params)))
+        return self.pages.pop(0)
+
+
+def test_endpoint_watcher_lists_pages():
+    epwatcher = pytest.importorskip("microscope.monitor.epwatcher")
+    pages = [{'items': [cep(test_endpoints[0], "1")],
+              'metadata': {'continue': 'a', 'resourceVersion': "5"}},
+             {'items': [cep(test_endpoints[1], "2"),
+                        cep({'id': 9999, 'status': {}}, "4")],
+              'metadata': {'continue': 'b', 'resourceVersion': "5"}},
+             {'items': [cep(test_endpoints[2], "3")],
+              'metadata': {'resourceVersion': "7"}}]
+    resolver = EndpointResolver(test_endpoints[3:5])
+    watcher = epwatcher.EndpointWatcher(resolver, FakeCRDs(pages),
+                                        page_size=1)
+    watcher.relist()
+
+    assert [q for _, q in watcher.crds.page_queries] == [
+        {'limit': 1}, {'limit': 1, 'continue': 'a'},
+        {'limit': 1, 'continue': 'b'}]
+    assert watcher.crds.page_queries[0][0] == (
+        '/apis/cilium.io/v2/ciliumendpoints')
+    assert watcher.resource_version == "7"
+    assert set(resolver.endpoints) == {ep['id']
+                                       for ep in test_endpoints[:3]}
+
+
+def test_endpoint_watcher_watches():
+    epwatcher = pytest.importorskip("microscope.monitor.epwatcher")
+    resolver = EndpointResolver([])
+    crds = FakeCRDs(watches=[[
+        {'type': 'ADDED', 'object': cep(test_endpoints[0], "8")},
+        {'type': 'ADDED', 'object': cep(test_endpoints[4], "9")},
+        {'type': 'DELETED', 'object': cep(test_endpoints[0], "10")}]])
+    watcher = epwatcher.EndpointWatcher(resolver, crds)
+    crds.on_last_watch = watcher.stop
+    watcher.resource_version = "7"
+    watcher.watch_endpoints()
+
+    assert resolver.resolve_ip("10.0.0.5") == "default:app3"
+    assert resolver.resolve_ip("10.0.0.1") == ""
+    assert watcher.resource_version == "10"
+    # the stream ended and was resumed from the last event
+    assert [c['resource_version'] for c in crds.watch_calls] == ["7", "10"]
+    assert crds.watch_calls[0]['_request_timeout'] == 300
+
+
+def test_endpoint_watcher_skips_incomplete_endpoints():
+    epwatcher = pytest.importorskip("microscope.monitor.epwatcher")
+    resolver = EndpointResolver([])
+    creating = {'id': 9999, 'status': {'state': 'waiting-for-identity'}}
+    crds = FakeCRDs(watches=[[
+        {'type': 'ADDED', 'object': cep(creating, "8", name="app3")},
+        {'type': 'ADDED', 'object': cep(test_endpoints[0], "9")}]])
+    watcher = epwatcher.EndpointWatcher(resolver, crds)
+    crds.on_last_watch = watcher.stop
+    watcher.resource_version = "7"
+    watcher.watch_endpoints()
+
+    assert resolver.resolve_ip("10.0.0.1") == "default:app2"
+    assert 9999 not in resolver.endpoints
+    assert watcher.resource_version == "9"
+    assert [c['resource_version'] for c in crds.watch_calls] == ["7", "9"]
+
+
+def test_compact_endpoint():
+    compact = [compact_endpoint(ep) for ep in test_endpoints]
+    status = test_endpoints[0]['status']
+    assert compact[0] == {
+        'id': test_endpoints[0]['id'],
+        'status': {
+            'external-identifiers': status['external-identifiers'],
+            'networking': {
+                'addressing': status['networking']['addressing']},
+            'identity': {
+                'id': status['identity']['id'],
+                'labels': status['identity']['labels']},
+            'labels': {
+                'security-relevant': status['labels']['security-relevant']},
+        }}
+
+    full = EndpointResolver(test_endpoints)
+    resolver = EndpointResolver(compact)
+    assert resolver.ip_resolutions == full.ip_resolutions
+    assert resolver.epid_resolutions == full.epid_resolutions
+    assert resolver.identities == full.identities
+    assert resolver.resolve_endpoint_ids(
+        ['id=app1'], ['default:app2'], [], 'default') == (
+        full.resolve_endpoint_ids(
+            ['id=app1'], ['default:app2'], [], 'default'))
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    trie.insert("10.0.0.0/8", "cluster")
+    trie.insert("10.96.0.0/12", "services")
+    trie.insert("10.96.0.1", "svc/default:kubernetes")
+    trie.insert("f00d::/16", "pods-v6")
+    trie.insert("0.0.0.0/0", "world")
+
+    assert len(trie) == 5
+    assert trie.lookup("10.96.0.1") == "svc/default:kubernetes"
+    assert trie.lookup("10.96.0.2") == "services"
+    assert trie.lookup("10.1.2.3") == "cluster"
+    assert trie.lookup("8.8.8.8") == "world"
+    assert trie.lookup("f00d::a0f:0:0:1686") == "pods-v6"
+    assert trie.lookup("fe80::1") is None
+    assert trie.lookup("not-an-ip") is None
+
+
+def test_resolver_cidr_names(tmp_path):
+    path = tmp_path / "cidrs"
+    path.write_text("# nodes\n192.168.99.100 node/minikube\n\n"
+                    "10.0.0.0/24 pod network\n")
+    resolver = EndpointResolver(test_endpoints)
+    for cidr, name in load_cidr_names(str(path)):
+        resolver.add_cidr(cidr, name)
+
+    assert resolver.resolve_ip("10.0.0.1") == "default:app2"
+    assert resolver.resolve_ip("10.0.0.200") == "pod network"
+    assert resolver.resolve_ip("192.168.99.100") == "node/minikube"
+    assert resolver.resolve_ip("192.168.99.101") == ""
+
+    path.write_text("10.0.0.0/33 bad\n")
+    with pytest.raises(ValueError, match=":1:"):
+        load_cidr_names(str(path))
+
+
+def test_lru_cache():
+    now = [0.0]
+    cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache.put("a", None, ttl=1)
+    assert cache.get("a", "missing") is None
+    now[0] = 5
+    assert cache.get("a", "missing") == "missing"
+    now[0] = 11
+    assert cache.get("c") is None
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (4, 3)
+
+
+def test_identity_cache():
+    calls = []
+
+    def list_identities():
+        calls.append(1)
+        return {'items': [
+            {'metadata': {'name': '16777217'},
+             'security-labels': {'cidr:10.0.0.0/8': '',
+                                 'reserved:world': ''}},
+            {'metadata': {'name': '5555'},
+             'security-labels': {'k8s:app': 'remote',
+                                 'k8s:io.kubernetes.pod.namespace': 'ns'}},
+            {'metadata': {'name': '6666'},
+             'security-labels': {'k8s:app': 'other'}},
+        ]}
+
+    resolver = EndpointResolver(test_endpoints)
+    updates = []
+
+    def on_update():
+        updates.append(1)
+        resolver.changed()
+
+    cache = IdentityCache(list_identities, batch_delay=0.01,
+                          on_update=on_update)
+    resolver.identity_source = cache
+    formatter = EventFormatter(resolver)
+
+    assert formatter.get_ep_repr(None, None, None, 5555) == "5555"
+    assert resolver.resolve_identity(16777217) is None
+    assert resolver.resolve_identity(7777) is None
+    cache.start()
+    deadline = time.time() + 5
+    while not updates and time.time() < deadline:
+        time.sleep(0.01)
+    cache.stop()
+
+    assert len(calls) == 1
+    assert formatter.get_ep_repr(None, None, None, 5555) == "k8s:app=remote"
+    assert resolver.resolve_identity(16777217) == [
+        'cidr:10.0.0.0/8', 'reserved:world']
+    assert resolver.resolve_identity(7777) is None
+    # identities which were listed but not asked for are cached too
+    assert resolver.resolve_identity(6666) == ['k8s:app=other']
+    assert len(calls) == 1
+
+
+def test_identity_cache_fetch():
+    objs = {str(i): {'metadata': {'name': str(i)},
+                     'security-labels': {'k8s:app': f'app{i}'}}
+            for i in range(1000, 1005)}
+    lists = []
+    gets = []
+
+    def list_identities():
+        lists.append(1)
+        return {'items': list(objs.values())}
+
+    def get_identity(name):
+        gets.append(name)
+        return objs.get(name)
+
+    cache = IdentityCache(list_identities, get_identity, maxsize=4,
+                          max_gets=2)
+
+    # a few misses are fetched by name, without listing the cluster
+    assert cache.fetch({1000, 9999}) == {1000: ['k8s:app=app1000']}
+    assert sorted(gets) == ['1000', '9999']
+    assert not lists
+
+    ids = {1000, 1001, 1002}
+    found = cache.fetch(ids)
+    assert len(found) == 5
+    assert len(lists) == 1
+    cache.store(ids, found)
+    assert [cache.lookup(i) is not None for i in sorted(ids)] == [
+        True, True, True]
+    assert len(cache.cache) == 4
+
+
+def test_formatter_cache():
+    resolver = EndpointResolver(test_endpoints)
+    formatter = EventFormatter(resolver)
+
+    assert formatter.get_ep_repr("10.0.0.9", "80", 0, 2) == (
+        "reserved:world 10.0.0.9:80")
+    assert formatter.get_ep_repr("10.0.0.9", "80", 0, 2) == (
+        "reserved:world 10.0.0.9:80")
+    assert formatter.get_ep_repr("10.0.0.1", "80", 5766, 49055) == (
+        "default:app2 10.0.0.1:80")
+    assert formatter.cache_stats() == {'endpoints': (1, 2),
+                                       'identities': (0, 1)}
+
+    resolver.add_cidr("10.0.0.0/24", "pod network")
+    assert formatter.get_ep_repr("10.0.0.9", "80", 0, 2) == (
+        "pod network 10.0.0.9:80")
+
+
+def test_json_event_formatter():
+    resolver = EndpointResolver(test_endpoints)
+    formatter = JSONEventFormatter(resolver)
+    trace = MonitorEvent("trace", "minikube", 12.5, cpu="CPU 01:",
+                         src_ip="10.0.0.1", dst_ip="10.0.0.9",
+                         src_port="80", dst_port="37934", src_ep=5766,
+                         dst_ep=0, src_identity=49055, dst_identity=2)
+
+    for backend in ["stdlib", "orjson"]:
+        if backend == "orjson" and jsoncodec.orjson is None:
+            continue
+        jsoncodec.use_backend(backend)
+        line = formatter.format(trace)
+        assert "\n" not in line
+        assert json.loads(line) == {
+            "node": "minikube", "timestamp": 12.5, "type": "trace",
+            "cpu": "CPU 01:",
+            "src": {"ip": "10.0.0.1", "port": "80", "endpoint": 5766,
+                    "name": "default:app2", "identity": 49055},
+            "dst": {"ip": "10.0.0.9", "port": "37934", "identity": 2,
+                    "labels": ["reserved:world"]}}
+        assert json.loads(formatter.format("raw line", "minikube")) == {
+            "node": "minikube", "type": "text", "message": "raw line"}
+    jsoncodec.use_backend("orjson" if jsoncodec.orjson else "stdlib")
+
+
+def test_segment_recorder(tmp_path):
+    recorder = SegmentRecorder(str(tmp_path), "minikube", segment_bytes=80,
+                               codec="gzip")
+    processor = MonitorOutputProcessorJSON("minikube", recorder)
+    processor.add_out('{"type":"unknown","a":1}\n{"type":"unknown","a":2}\n')
+    assert len(list(processor)) == 2
+    processor.add_out('{"type":"unknown","a":3}\n')
+    assert len(list(processor)) == 1
+    recorder.close()
+
+    segments = read_index(str(tmp_path / "minikube.index"))
+    assert [s["events"] for s in segments] == [2, 1]
+    assert segments[1]["offset"] == segments[0]["length"]
+    assert segments_in_window(segments, since=segments[0]["start"],
+                              until=segments[1]["end"]) == segments
+    assert segments_in_window(segments, since=segments[1]["end"] + 1) == []
+
+    lines = read_segment(str(tmp_path), segments[1]).decode().splitlines()
+    marker = json.loads(lines[0])
+    assert marker["type"] == "timestamp"
+    assert marker["timestamp"] == segments[1]["start"]
+    assert json.loads(lines[1]) == {"type": "unknown", "a": 3}
+
+
+def test_resolver_snapshot(tmp_path):
+    resolver = EndpointResolver(test_endpoints)
+    resolver.add_cidr("192.168.99.0/24", "node/minikube")
+    resolver.identities[49055] = ["reserved:world", "cidr:1.1.1.1/32"]
+    save_snapshot(str(tmp_path), resolver.snapshot())
+
+    resolver.remove_endpoint(5766)
+    save_snapshot(str(tmp_path), resolver.snapshot())
+
+    restored = EndpointResolver([])
+    restored.load_snapshot(load_snapshot(str(tmp_path)))
+    # endpoints removed between snapshots are kept
+    assert restored.resolve_ip("10.0.0.1") == "default:app2"
+    assert restored.resolve_ip("f00d::a0f:0:0:1686") == "default:app2"
+    assert restored.resolve_ip("192.168.99.7") == "node/minikube"
+    assert restored.resolve_eid(5766) == "default:app2"
+    assert restored.resolve_identity(49055) == [
+        "reserved:world", "cidr:1.1.1.1/32"]
+    assert restored.resolve_endpoint_ids(["id=app2"], [], [], "default") \
+        == {5766}
@@ -0,0 +1,160 @@
+from collections import deque
+from typing import Optional
+from multiprocessing import Queue
+from multiprocessing.connection import Connection
+import queue as queuemodule
+
+from microscope.monitor.ring import FrameTooLarge
+
+
+drop_policies = ['block', 'drop-oldest', 'drop-newest', 'sample']
+
+
+class BatchSender:
+    """BatchSender coalesces messages of one monitor into batch frames,
+    so every queue item costs one pickle and one pipe write for many
+    events. A frame looks like
+
+        {'name': pod_name, 'node_name': node_name, 'outputs': [msg, ...],
+         'dropped': 0}
+
+    Frames are sent when `max_events` messages are pending or when
+    `flush` is called, which monitors do once per poll iteration.
+
+    The data queue is bounded. `policy` decides what happens when it is
+    full:
+
+    block: wait for the consumer, the monitor stops reading its stream.
+           Waiting ends when `shutdown` becomes readable. Without
+           `blocking`, frames which do not fit are kept instead and
+           `blocked` is set, the caller stops reading its stream until
+           a later flush sent them.
+    drop-newest: drop the frame which does not fit
+    drop-oldest: keep up to `backlog` frames in the monitor and drop the
+                 oldest of them. Monitors retry sending them every
+                 `retry_interval` seconds, see wait_timeout.
+    sample: keep only every `sample_rate`-th message while the queue is
+            full, frames which still do not fit are dropped
+
+    Frames too large for a shared memory ring are split in halves, a
+    single message which does not fit is dropped.
+
+    `dropped` is the total number of messages dropped so far by this
+    sender, so consumers learn about losses from any later frame.
+    """
+    def __init__(self, queue: Queue, name: str, node_name: str,
+                 max_events: int = 512, policy: str = 'block',
+                 backlog: int = 64, sample_rate: int = 10,
+                 shutdown: Connection = None, retry_interval: float = 0.1,
+                 blocking: bool = True):
+        if policy not in drop_policies:
+            raise ValueError(f"unknown drop policy {policy}")
+        self.queue = queue
+        self.name = name
+        self.node_name = node_name
+        self.max_events = max_events
+        self.policy = policy
+        self.backlog = deque()
+        self.backlog_size = backlog
+        self.sample_rate = sample_rate
+        self.shutdown = shutdown
+        self.retry_interval = retry_interval
+        self.blocking = blocking
+        self.pending = []
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.congested = False
+        self.sample_counter = 0
+
+    def add(self, msg):
+        if self.congested and self.policy == 'sample':
+            self.sample_counter += 1
+            if self.sample_counter % self.sample_rate:
+                self.dropped += 1
+                return
+        self.pending.append(msg)
+        if len(self.pending) >= self.max_events:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.backlog.append(self.pending)
+            self.pending = []
+
+        while self.backlog:
+            outputs = self.backlog[0]
+            try:
+                sent = self.send(outputs)
+            except FrameTooLarge:
+                self.backlog.popleft()
+                if len(outputs) > 1:
+                    half = len(outputs) // 2
+                    self.backlog.appendleft(outputs[half:])
+                    self.backlog.appendleft(outputs[:half])
+                else:
+                    self.dropped += len(outputs)
+                continue
+            if sent:
+                self.backlog.popleft()
+                continue
+            if self.policy != 'drop-oldest' and not self.blocked:
+                self.backlog.popleft()
+                self.dropped += len(outputs)
+            break
+
+        while len(self.backlog) > self.backlog_size and not self.blocked:
+            self.dropped += len(self.backlog.popleft())
+
+    @property
+    def blocked(self) -> bool:
+        """blocked is set while frames of a non-blocking sender with the
+        block policy wait for room in the queue
+        """
+        return (self.policy == 'block' and not self.blocking
+                and bool(self.backlog))
+
+    def wait_timeout(self, timeout: Optional[float]) -> Optional[float]:
+        """wait_timeout shortens the timeout of a read loop to
+        `retry_interval` while frames are held back, so they are sent
+        when the consumer catches up even if the stream is quiet
+        """
+        if not self.backlog:
+            return timeout
+        if timeout is None:
+            return self.retry_interval
+        return min(timeout, self.retry_interval)
+
+    def send(self, outputs) -> bool:
+        frame = {
+            'name': self.name,
+            'node_name': self.node_name,
+            'outputs': outputs,
+            'dropped': self.dropped}
+        try:
+            if self.policy == 'block' and self.blocking:
+                self.put_blocking(frame)
+            else:
+                self.queue.put(frame, False)
+        except queuemodule.Full:
+            self.congested = True
+            return False
+        self.congested = False
+        self.reported_dropped = self.dropped
+        return True
+
+    def put_blocking(self, frame):
+        while True:
+            try:
+                self.queue.put(frame, True, 0.5)
+                return
+            except queuemodule.Full:
+                if self.shutdown is not None and self.shutdown.poll():
+                    raise
+
+    def close(self):
+        """close sends the remaining messages and lets the consumer know
+        about messages dropped since the last frame
+        """
+        self.flush()
+        if self.dropped != self.reported_dropped:
+            self.send([])
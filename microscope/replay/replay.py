@@ -0,0 +1,63 @@
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+from typing import List
+import os
+import sys
+
+from microscope.batch.writer import BatchWriter
+from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.recorder import load_snapshot, read_index
+from microscope.monitor.recorder import segments_in_window
+from microscope.monitor.runner import MonitorArgs
+from microscope.replay.segments import EventFilter, init_worker
+from microscope.replay.segments import merge_segments, parse_segment
+
+
+def parse_time(value: str) -> float:
+    """parse_time accepts unix timestamps and ISO 8601 times, times
+    without a timezone are local
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def replay(directory: str, args: MonitorArgs, namespace: str,
+           nodes: List[str] = None, since: float = None,
+           until: float = None, output: str = "text", workers: int = None,
+           line_buffered: bool = False):
+    """replay prints events recorded to `directory` with --record, like
+    batch mode prints live events. Filters are resolved against the
+    endpoint snapshot saved with the recording.
+
+    Segments within the [since, until] window are parsed on a pool of
+    `workers` processes, all CPUs by default, and printed merged in
+    timestamp order.
+    """
+    resolver = EndpointResolver([])
+    resolver.load_snapshot(load_snapshot(directory))
+    related_ids, to_ids, from_ids = args.resolve_endpoints(resolver,
+                                                           namespace)
+    event_filter = EventFilter(args.types, related_ids, to_ids, from_ids,
+                               since, until)
+
+    segments = []
+    for path in sorted(glob(os.path.join(directory, "*.index"))):
+        segments.extend(read_index(path))
+    if nodes:
+        segments = [s for s in segments if s['node'] in nodes]
+    segments = segments_in_window(segments, since, until)
+
+    workers = workers or os.cpu_count()
+    writer = BatchWriter(sys.stdout, line_buffered)
+    with Pool(workers, init_worker,
+              (directory, event_filter, output)) as pool:
+        def submit(segment):
+            return pool.apply_async(parse_segment, (segment,)).get
+
+        for _, text in merge_segments(segments, submit, 2 * workers):
+            writer.write(text)
+            writer.frame_done()
+    writer.flush()
@@ -0,0 +1,155 @@
+"""segments parses recorded segments and merges their events in
+timestamp order. Parsing runs in worker processes, see replay.
+"""
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import heapq
+from operator import itemgetter
+
+from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.event import MonitorEvent
+from microscope.monitor.formatter import EventFormatter, JSONEventFormatter
+from microscope.monitor.parser import MonitorOutputProcessorJSON
+from microscope.monitor.recorder import load_snapshot, read_segment
+
+
+# `cilium monitor --type` names of event types which differ
+event_types = {'l7': 'logRecord'}
+
+
+class EventFilter:
+    """EventFilter selects recorded events like `cilium monitor` selects
+    live events with --type, --related-to, --to and --from. Filters are
+    combined, an event has to match all of them. Events without
+    endpoints and unparsed output only match when no endpoint filter is
+    set. Events outside of the [since, until] window never match.
+    """
+    def __init__(self, types: Iterable[str] = (),
+                 related_ids: Iterable[int] = (),
+                 to_ids: Iterable[int] = (),
+                 from_ids: Iterable[int] = (),
+                 since: float = None, until: float = None):
+        self.types = {event_types.get(t, t) for t in types}
+        self.related_ids = set(related_ids)
+        self.to_ids = set(to_ids)
+        self.from_ids = set(from_ids)
+        self.since = since
+        self.until = until
+
+    def matches(self, event, timestamp: float) -> bool:
+        if self.since is not None and timestamp < self.since:
+            return False
+        if self.until is not None and timestamp > self.until:
+            return False
+
+        if not isinstance(event, MonitorEvent):
+            return not (self.types or self.related_ids or self.to_ids
+                        or self.from_ids)
+        if self.types and event.type not in self.types:
+            return False
+        if self.related_ids and not (event.src_ep in self.related_ids
+                                     or event.dst_ep in self.related_ids):
+            return False
+        if self.to_ids and event.dst_ep not in self.to_ids:
+            return False
+        if self.from_ids and event.src_ep not in self.from_ids:
+            return False
+        return True
+
+
+class SegmentParser:
+    """SegmentParser turns a recorded segment into (timestamp, output)
+    pairs of the events passing `event_filter`. Output is formatted like
+    batch mode prints it, as text or with `output` "ndjson" as JSON
+    lines.
+    """
+    def __init__(self, directory: str, resolver: EndpointResolver,
+                 event_filter: EventFilter, output: str = "text"):
+        self.directory = directory
+        self.event_filter = event_filter
+        self.ndjson = output == "ndjson"
+        if self.ndjson:
+            self.formatter = JSONEventFormatter(resolver)
+        else:
+            self.formatter = EventFormatter(resolver)
+
+    def parse(self, segment: Dict) -> List[Tuple[float, str]]:
+        node = segment['node']
+        processor = MonitorOutputProcessorJSON(node)
+        data = read_segment(self.directory, segment)
+        outputs = []
+        for event in processor.parse_recording(data):
+            timestamp = processor.timestamp
+            if not self.event_filter.matches(event, timestamp):
+                continue
+            if self.ndjson:
+                text = self.formatter.format(event, node) + "\n"
+            else:
+                text = f"\n{node}: {self.formatter.format(event)}"
+            outputs.append((timestamp, text))
+        return outputs
+
+
+# SegmentParser of a worker process, set up by init_worker
+worker_parser = None
+
+
+def init_worker(directory: str, event_filter: EventFilter, output: str):
+    global worker_parser
+    resolver = EndpointResolver([])
+    resolver.load_snapshot(load_snapshot(directory))
+    worker_parser = SegmentParser(directory, resolver, event_filter, output)
+
+
+def parse_segment(segment: Dict) -> List[Tuple[float, str]]:
+    return worker_parser.parse(segment)
+
+
+class SegmentScheduler:
+    """SegmentScheduler submits segments for parsing in order of their
+    start time, up to `lookahead` segments past the latest one asked
+    for. Results are ready by the time the merge needs them, while
+    parsed segments waiting to be merged stay bounded.
+
+    submit: starts parsing a segment and returns a function which waits
+            for and returns the result, e.g. `AsyncResult.get`
+    """
+    def __init__(self, segments: List[Dict],
+                 submit: Callable[[Dict], Callable[[], Any]],
+                 lookahead: int):
+        self.segments = segments
+        self.submit = submit
+        self.lookahead = lookahead
+        self.submitted = 0
+        self.pending = {}
+
+    def get(self, index: int):
+        last = min(index + self.lookahead, len(self.segments) - 1)
+        while self.submitted <= last:
+            self.pending[self.submitted] = self.submit(
+                self.segments[self.submitted])
+            self.submitted += 1
+        return self.pending.pop(index)()
+
+
+def merge_segments(segments: List[Dict],
+                   submit: Callable[[Dict], Callable[[], Any]],
+                   lookahead: int) -> Iterator[Tuple[float, str]]:
+    """merge_segments returns (timestamp, output) pairs of all segments
+    in timestamp order. Segments of a node follow each other in time, so
+    each node's segments are read in sequence and nodes are merged with
+    heapq.merge.
+    """
+    segments = sorted(segments,
+                      key=lambda s: (s['start'], s['node'], s['offset']))
+    scheduler = SegmentScheduler(segments, submit, lookahead)
+
+    by_node = {}
+    for index, segment in enumerate(segments):
+        by_node.setdefault(segment['node'], []).append(index)
+
+    def node_outputs(indexes):
+        for index in indexes:
+            yield from scheduler.get(index)
+
+    return heapq.merge(*(node_outputs(i) for i in by_node.values()),
+                       key=itemgetter(0))
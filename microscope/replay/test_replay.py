@@ -0,0 +1,42 @@
+from microscope.monitor.epresolver import EndpointResolver
+from microscope.monitor.recorder import SegmentRecorder, read_index
+from microscope.replay.segments import EventFilter, SegmentParser
+from microscope.replay.segments import merge_segments
+
+
+def test_replay_segments(tmp_path):
+    event = ('{"type":"trace","source":%d,"dstID":0,"cpu":"CPU 01:",'
+             '"summary":{"l3":{"src":"10.0.0.1","dst":"10.0.0.2"}}}')
+    recorders = {node: SegmentRecorder(str(tmp_path), node, codec="gzip",
+                                       segment_seconds=2)
+                 for node in ["a", "b"]}
+    for t in range(6):
+        node = "a" if t % 2 else "b"
+        frame = (event % t).encode()
+        recorders[node].write_frames(float(t), frame, [(0, len(frame))])
+    for recorder in recorders.values():
+        recorder.close()
+
+    segments = read_index(str(tmp_path / "a.index")) + read_index(
+        str(tmp_path / "b.index"))
+    assert len(segments) == 4
+
+    resolver = EndpointResolver([])
+    parser = SegmentParser(str(tmp_path), resolver, EventFilter())
+    submitted = []
+
+    def submit(segment):
+        submitted.append(segment)
+        return lambda: parser.parse(segment)
+
+    merged = list(merge_segments(segments, submit, 1))
+    assert [t for t, _ in merged] == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    assert merged[1][1].startswith("\na: trace")
+    assert len(submitted) == 4
+
+    parser.event_filter = EventFilter(["trace"], from_ids=[1, 4],
+                                      since=2.0)
+    merged = list(merge_segments(segments, submit, 1))
+    assert [t for t, _ in merged] == [4.0]
+    parser.event_filter = EventFilter(["drop"])
+    assert list(merge_segments(segments, submit, 1)) == []
@@ -0,0 +1,114 @@
+from typing import List, Tuple
+import os
+import queue as queuemodule
+import threading
+import time
+
+
+class CaptureWriter:
+    """CaptureWriter appends output of every node to files in `directory`
+    from a background thread, so writing never blocks the UI.
+
+    Files are named `<node>-<start time>-<n>.log`. A node's file is
+    rotated when it grows past `max_bytes` or is older than `max_age`
+    seconds. Writes are buffered and flushed and fsynced every
+    `fsync_interval` seconds, on `sync` and on `close`.
+    """
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024,
+                 max_age: float = 3600.0, fsync_interval: float = 1.0,
+                 buffer_size: int = 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self.queue = queuemodule.Queue()
+        # node -> (file, bytes written, opened at)
+        self.files = {}
+        self.sequence = {}
+        self.dirty = set()
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, node: str, lines: List[str],
+              spilled: Tuple[str, int] = None):
+        """write queues lines of node. If `spilled` is set, the first
+        bytes of a file given as (path, size) are written before them.
+        """
+        self.queue.put((node, lines, spilled))
+
+    def sync(self):
+        """sync requests a flush and fsync of all files"""
+        self.queue.put(None)
+
+    def close(self):
+        self.queue.put(self)
+        self.thread.join()
+
+    def run(self):
+        last_sync = time.monotonic()
+        while True:
+            timeout = max(0, last_sync + self.fsync_interval
+                          - time.monotonic())
+            try:
+                item = self.queue.get(True, timeout)
+            except queuemodule.Empty:
+                item = None
+
+            try:
+                if item is self:
+                    self.close_files()
+                    return
+                if item is not None:
+                    self.append(*item)
+                if (item is None or time.monotonic() - last_sync
+                        >= self.fsync_interval):
+                    self.sync_files()
+                    last_sync = time.monotonic()
+            except OSError as e:
+                # keep the UI running, the error is shown in the header
+                self.error = e
+
+    def append(self, node: str, lines: List[str],
+               spilled: Tuple[str, int] = None):
+        data = b""
+        if spilled is not None:
+            path, size = spilled
+            with open(path, 'rb') as f:
+                data = f.read(size)
+        if lines:
+            data += ("\n".join(lines) + "\n").encode()
+        if not data:
+            return
+
+        f, size, opened_at = self.files.get(node) or self.open(node)
+        if (size and (size + len(data) > self.max_bytes
+                      or time.time() - opened_at > self.max_age)):
+            f.close()
+            f, size, opened_at = self.open(node)
+        f.write(data)
+        self.files[node] = (f, size + len(data), opened_at)
+        self.dirty.add(node)
+
+    def open(self, node: str):
+        seq = self.sequence.get(node, 0)
+        self.sequence[node] = seq + 1
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.directory, f"{node}-{stamp}-{seq}.log")
+        f = open(path, 'ab', buffering=self.buffer_size)
+        return (f, 0, time.time())
+
+    def sync_files(self):
+        for node in self.dirty:
+            f = self.files[node][0]
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty = set()
+
+    def close_files(self):
+        self.sync_files()
+        for f, _, _ in self.files.values():
+            f.close()
+        self.files = {}
@@ -0,0 +1,35 @@
+import time
+
+
+class RedrawLimiter:
+    """RedrawLimiter coalesces updates of the UI into at most `fps`
+    redraws per second. The update thread marks the screen dirty when it
+    queued changes and asks `redraw_due` whether to wake the main loop.
+    """
+    def __init__(self, fps: int):
+        self.frame_interval = 1 / fps
+        self.last_redraw = float('-inf')
+        self.dirty = False
+
+    def update(self):
+        self.dirty = True
+
+    def wait_timeout(self, idle: float) -> float:
+        """wait_timeout returns how long the update thread can wait for
+        more changes before the pending ones are due on screen
+        """
+        if not self.dirty:
+            return idle
+        return max(0, self.last_redraw + self.frame_interval
+                   - time.monotonic())
+
+    def redraw_due(self) -> bool:
+        """redraw_due returns True if the screen is dirty and the last
+        redraw was at least a frame ago, the screen is then clean again
+        """
+        now = time.monotonic()
+        if not self.dirty or now - self.last_redraw < self.frame_interval:
+            return False
+        self.last_redraw = now
+        self.dirty = False
+        return True
@@ -0,0 +1,79 @@
+from collections import deque
+from typing import List, Optional, Tuple
+import os
+import threading
+
+
+class Scrollback:
+    """Scrollback keeps the last `limit` lines of a column.
+
+    Lines are numbered from 0 in the order they were appended and keep
+    their position when older lines are evicted, so a view can hold on
+    to a position while the buffer moves. `start` is the position of the
+    oldest line kept.
+
+    If `spill_path` is set, evicted lines are appended to that file
+    instead of being lost.
+
+    Lines are appended from the UI update thread and read while drawing,
+    so all access goes through `lock`.
+    """
+    def __init__(self, limit: int, spill_path: str = None):
+        self.limit = limit
+        self.lines = deque()
+        self.start = 0
+        self.spill_path = spill_path
+        self.spill = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def end(self) -> int:
+        """end is the position after the newest line"""
+        return self.start + len(self.lines)
+
+    def append(self, lines: List[str]):
+        with self.lock:
+            self.lines.extend(lines)
+            evicted = len(self.lines) - self.limit
+            if evicted <= 0:
+                return
+            old = [self.lines.popleft() for _ in range(evicted)]
+            self.start += evicted
+            if self.spill_path is not None:
+                if self.spill is None:
+                    self.spill = open(self.spill_path, 'a')
+                self.spill.write("\n".join(old) + "\n")
+
+    def get(self, position: int) -> str:
+        """get returns the line at position, None if it is not kept"""
+        with self.lock:
+            index = position - self.start
+            if 0 <= index < len(self.lines):
+                return self.lines[index]
+            return None
+
+    def snapshot(self) -> Tuple[Optional[Tuple[str, int]], List[str]]:
+        """snapshot returns a copy of the lines kept in memory, with the
+        path and size of the spill file if lines were spilled to disk.
+        Lines spilled later are appended after that size.
+        """
+        with self.lock:
+            spilled = None
+            if self.spill is not None:
+                self.spill.flush()
+                spilled = (self.spill_path,
+                           os.fstat(self.spill.fileno()).st_size)
+            return spilled, list(self.lines)
+
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+
+def spill_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}.scrollback")
@@ -0,0 +1,67 @@
+import time
+
+from microscope.ui.scrollback import Scrollback
+from microscope.ui.capture import CaptureWriter
+from microscope.ui.redraw import RedrawLimiter
+
+
+def test_scrollback(tmp_path):
+    spill = tmp_path / "node1.scrollback"
+    scrollback = Scrollback(3, str(spill))
+    scrollback.append(["line0", "line1"])
+    assert (scrollback.start, scrollback.end) == (0, 2)
+    assert not spill.exists()
+
+    scrollback.append(["line2", "line3", "line4"])
+    assert (scrollback.start, scrollback.end) == (2, 5)
+    assert scrollback.get(1) is None
+    assert scrollback.get(2) == "line2"
+    assert scrollback.get(5) is None
+    assert scrollback.snapshot() == ((str(spill), 12),
+                                     ["line2", "line3", "line4"])
+
+    scrollback.close()
+    assert spill.read_text() == "line0\nline1\n"
+
+    unspilled = Scrollback(1)
+    unspilled.append(["a", "b"])
+    assert unspilled.snapshot() == (None, ["b"])
+
+
+def test_capture_writer(tmp_path):
+    directory = tmp_path / "capture"
+    capture = CaptureWriter(str(directory), max_bytes=24)
+    spill = tmp_path / "cilium-1.scrollback"
+    spill.write_text("spilled\nlater\n")
+    capture.write("cilium-1", ["history"], (str(spill), 8))
+    capture.write("cilium-1", ["event1", "event2"])
+    capture.write("cilium-2", ["event3"])
+    capture.close()
+
+    files = sorted(p.name for p in directory.iterdir())
+    assert len(files) == 3
+    assert files[0].startswith("cilium-1-") and files[0].endswith("-0.log")
+    assert files[1].endswith("-1.log")
+    assert [(directory / f).read_text() for f in files] == [
+        "spilled\nhistory\n", "event1\nevent2\n", "event3\n"]
+
+
+def test_redraw_limiter():
+    limiter = RedrawLimiter(10)
+    assert not limiter.redraw_due()
+    assert limiter.wait_timeout(1) == 1
+
+    limiter.update()
+    assert limiter.wait_timeout(1) == 0
+    assert limiter.redraw_due()
+    assert not limiter.redraw_due()
+
+    # updates within a frame are coalesced into the next redraw
+    limiter.update()
+    limiter.update()
+    assert 0 < limiter.wait_timeout(1) <= 0.1
+    assert not limiter.redraw_due()
+    time.sleep(0.1)
+    assert limiter.wait_timeout(1) == 0
+    assert limiter.redraw_due()
+    assert limiter.wait_timeout(1) == 1
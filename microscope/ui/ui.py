@@ -9,16 +9,66 @@ import urwid.raw_display
 
 from microscope.monitor.runner import MonitorRunner
 from microscope.monitor.monitor import Monitor
+from microscope.monitor.formatter import EventFormatter
+from microscope.ui.scrollback import Scrollback, spill_path
+from microscope.ui.capture import CaptureWriter
+from microscope.ui.redraw import RedrawLimiter
+
+
+class ScrollbackWalker(urwid.ListWalker):
+    """ScrollbackWalker shows a Scrollback in a ListBox. Text widgets are
+    only created for the rows the ListBox asks for, which are the visible
+    ones. While the focus is on the newest line, it follows new lines.
+    """
+    def __init__(self, scrollback: Scrollback):
+        self.scrollback = scrollback
+        self.focus = 0
+        self.widgets = {}
+
+    def widget(self, position: int):
+        widget = self.widgets.get(position)
+        if widget is None:
+            line = self.scrollback.get(position)
+            if line is None:
+                return None
+            if len(self.widgets) > 1000:
+                self.widgets.clear()
+            widget = urwid.Text(line)
+            self.widgets[position] = widget
+        return widget
+
+    def append(self, lines):
+        following = self.focus >= self.scrollback.end - 1
+        self.scrollback.append(lines)
+        if following or self.focus < self.scrollback.start:
+            self.focus = max(self.scrollback.end - 1, self.scrollback.start)
+        self._modified()
+
+    def get_focus(self):
+        return self.widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        return self.widget(position + 1), position + 1
+
+    def get_prev(self, position):
+        return self.widget(position - 1), position - 1
 
 
 class MonitorColumn:
-    def __init__(self, monitor: Monitor):
+    def __init__(self, monitor: Monitor, scrollback: Scrollback):
         self.monitor = monitor
-        self.widget = urwid.Text(monitor.output)
+        self.scrollback = scrollback
+        self.walker = ScrollbackWalker(scrollback)
+        self.walker.append([monitor.node_name])
+        self.widget = urwid.ListBox(self.walker)
         self.last_updated = time.time()
 
-    def set_text(self, text):
-        self.widget.set_text(text)
+    def add_lines(self, lines):
+        self.walker.append(lines)
         self.last_updated = time.time()
 
 
@@ -33,28 +83,72 @@ def remove_stale_columns(content: urwid.MonitoredList,
     to_remove = []
     for k, c in columns.items():
         if now - c.last_updated > timeout:
-            content.remove((c.widget, ('weight', 1, False)))
+            for i, (widget, _) in enumerate(content):
+                if widget is c.widget:
+                    del content[i]
+                    break
             to_remove.append(k)
 
     for key in to_remove:
         del columns[key]
 
 
-def ui(runner: MonitorRunner, empty_column_timeout: int):
-    monitor_columns = {m.pod_name: MonitorColumn(m)
-                       for m in runner.monitors}
+def ui(runner: MonitorRunner, empty_column_timeout: int,
+       scrollback: int = 10000, spill_dir: str = None, fps: int = 20,
+       capture_dir: str = None):
+    """ui shows monitor output in one column per node. Each column keeps
+    its last `scrollback` lines, older lines are appended to a file in
+    `spill_dir` if it is set. The screen is redrawn at most `fps` times
+    per second.
+
+    If `capture_dir` is set, all output is written to files there while
+    running. Otherwise the s key starts capturing to the current
+    directory, beginning with the output kept in the columns.
+    """
+    formatter = EventFormatter(runner.resolver)
+    monitor_columns = {}
+    for m in runner.monitors:
+        spill = spill_path(spill_dir, m.pod_name) if spill_dir else None
+        monitor_columns[m.pod_name] = MonitorColumn(
+            m, Scrollback(scrollback, spill))
 
     text_header = (u"Cilium Microscope."
                    u"UP / DOWN / PAGE UP / PAGE DOWN scroll. F8 exits. "
-                   u"s dumps nodes output to disk. LEFT / RIGHT to switch "
+                   u"s captures nodes output to disk. LEFT / RIGHT to switch "
                    u"columns. z to zoom into column. z again to disable zoom")
 
     columns = urwid.Columns([c.widget for c in monitor_columns.values()],
                             5, min_width=20)
 
-    header = urwid.AttrWrap(urwid.Text(text_header), 'header')
-    listbox = urwid.ListBox(urwid.SimpleListWalker([columns]))
-    frame = urwid.Frame(urwid.AttrWrap(listbox, 'body'), header=header)
+    header_text = urwid.Text(text_header)
+    header = urwid.AttrWrap(header_text, 'header')
+    # drop counts seen by the update thread and shown in the header
+    dropped = {}
+    shown_dropped = {}
+
+    capture = None
+    if capture_dir:
+        capture = CaptureWriter(capture_dir)
+
+    def refresh_header():
+        text = text_header
+        if shown_dropped:
+            counts = ", ".join(f"{n} {c}"
+                               for n, c in sorted(shown_dropped.items()))
+            text += u"\nDropped events: " + counts
+        if capture is not None:
+            text += u"\nCapturing to " + os.path.abspath(capture.directory)
+            if capture.error is not None:
+                text += u", write failed: " + str(capture.error)
+        header_text.set_text(text)
+
+    def update_dropped(node: str, count: int):
+        shown_dropped[node] = count
+        refresh_header()
+
+    refresh_header()
+
+    frame = urwid.Frame(urwid.AttrWrap(columns, 'body'), header=header)
 
     palette = [
         ('body', 'black', 'light gray', 'standout'),
@@ -72,16 +166,17 @@ def ui(runner: MonitorRunner, empty_column_timeout: int):
     screen = urwid.raw_display.Screen()
 
     def dump_data():
-        timestamp = time.time()
-        outputs = {}
-        for m in runner.monitors:
-            if m.output_lock.acquire():
-                outputs[m.pod_name] = m.output
-                m.output_lock.release()
-
-        for name, o in outputs.items():
-            with open(name + "-" + str(timestamp), 'w') as f:
-                f.write(o)
+        nonlocal capture
+        if capture is not None:
+            capture.sync()
+            return
+        capture = CaptureWriter(os.getcwd())
+        # copied now, lines applied after this are written by
+        # apply_updates
+        for name, c in monitor_columns.items():
+            spilled, lines = c.scrollback.snapshot()
+            capture.write(name, lines, spilled)
+        refresh_header()
 
     def unhandled(key):
         global zoom
@@ -107,39 +202,84 @@ def ui(runner: MonitorRunner, empty_column_timeout: int):
 
             zoom = not zoom
         else:
-            runner.data_queue.put({})
+            # wakes up the update thread, which is busy anyway if the
+            # queue is full
+            try:
+                runner.data_queue.put_nowait({})
+            except queuemodule.Full:
+                pass
 
     mainloop = urwid.MainLoop(frame, palette, screen,
                               unhandled_input=unhandled, handle_mouse=False)
 
-    def wait_for_values(monitor_columns, queue, close_queue):
+    # Formatted lines and drop counts are collected by the update thread
+    # and applied to the widgets from the main loop, at most `fps` times
+    # per second. The main loop redraws after applying them.
+    pending = {'lines': {}, 'dropped': {}}
+    pending_lock = threading.Lock()
+
+    def apply_updates(_):
+        with pending_lock:
+            lines = pending['lines']
+            drops = pending['dropped']
+            pending['lines'] = {}
+            pending['dropped'] = {}
+
+        for name, column_lines in lines.items():
+            if capture is not None:
+                capture.write(name, column_lines)
+            if name in monitor_columns:
+                monitor_columns[name].add_lines(column_lines)
+        for node, count in drops.items():
+            update_dropped(node, count)
+        if capture is not None and capture.error is not None:
+            refresh_header()
+        return True
+
+    redraw_pipe = mainloop.watch_pipe(apply_updates)
+
+    prune_interval = min(empty_column_timeout, 5)
+
+    def prune_columns(loop, _):
+        remove_stale_columns(columns.contents,
+                             monitor_columns, empty_column_timeout)
+        loop.set_alarm_in(prune_interval, prune_columns)
+
+    if empty_column_timeout:
+        mainloop.set_alarm_in(prune_interval, prune_columns)
+
+    def wait_for_values(queue, close_queue):
+        limiter = RedrawLimiter(fps)
         while(close_queue.empty()):
             try:
-                output = queue.get(True, 1)
+                frame = queue.get(True, limiter.wait_timeout(1))
             except queuemodule.Empty:
-                continue
-
-            if ("name" in output and "output" in output
-                    and output["name"] in monitor_columns):
-                c = monitor_columns[output["name"]]
-                if c.monitor.output_lock.acquire():
-                    c.monitor.output += "\n" + output["output"]
-                    c.set_text(c.monitor.output)
-                    c.monitor.output_lock.release()
-
-            remove_stale_columns(columns.contents,
-                                 monitor_columns, empty_column_timeout)
-            try:
-                mainloop.draw_screen()
-            except AssertionError as e:
-                # this error is encountered when program is closing
-                # or screen is not ready to draw
-                # continue so it doesn't clutter the output
-                continue
+                frame = {}
+
+            node = frame.get("node_name")
+            if frame.get("dropped", 0) > dropped.get(node, 0):
+                dropped[node] = frame["dropped"]
+                with pending_lock:
+                    pending['dropped'][node] = frame["dropped"]
+                limiter.update()
+
+            if "name" in frame and "outputs" in frame:
+                lines = [formatter.format(o) for o in frame["outputs"]]
+                lines = "\n".join(lines).split("\n")
+                with pending_lock:
+                    column_lines = pending['lines'].setdefault(
+                        frame["name"], [])
+                    column_lines.extend(lines)
+                    if not spill_dir and capture is None:
+                        # older lines would be evicted right away
+                        del column_lines[:-scrollback]
+                limiter.update()
+
+            if limiter.redraw_due():
+                os.write(redraw_pipe, b'.')
 
     update_thread = threading.Thread(target=wait_for_values,
-                                     args=(monitor_columns,
-                                           runner.data_queue,
+                                     args=(runner.data_queue,
                                            runner.close_queue))
 
     # hack to ensure that ssl errors log before mainloop.run call
@@ -147,3 +287,8 @@ def ui(runner: MonitorRunner, empty_column_timeout: int):
     update_thread.start()
     mainloop.run()
     update_thread.join()
+    mainloop.remove_watch_pipe(redraw_pipe)
+    if capture is not None:
+        capture.close()
+    for c in monitor_columns.values():
+        c.scrollback.close()
@@ -33,7 +33,8 @@ setup(
     author_email='maciej@covalent.io',
     url='https://github.com/cilium/microscope',
     packages=[
-        'microscope', 'microscope.ui', 'microscope.monitor', 'microscope.batch'
+        'microscope', 'microscope.ui', 'microscope.monitor',
+        'microscope.batch', 'microscope.replay'
     ],
     entry_points={
         'console_scripts': [